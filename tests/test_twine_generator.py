@@ -0,0 +1,50 @@
+import json
+import re
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from twine_generator import Choice, GradingConfig, Passage, TwineStory
+
+
+class StreamHtmlEscapingTest(unittest.TestCase):
+    """Passage and grading JSON must not be able to break out of their script elements."""
+
+    HOSTILE = 'Clue <!--<script> and </script><b>end</b>'
+
+    def render(self):
+        story = TwineStory(
+            title="Escaping",
+            grading=GradingConfig(enabled=True, concept_points={self.HOSTILE: 10},
+                                  total_points=10, passing_points=7)
+        )
+        story.add_passage(Passage(name="Start", content=self.HOSTILE,
+                                  choices=[Choice("Next", self.HOSTILE)]))
+        story.add_passage(Passage(name=self.HOSTILE, content="Done"))
+        return story.generate_html()
+
+    def test_script_bodies_contain_no_markup(self):
+        html_output = self.render()
+        for body in re.findall(r'<script[^>]*>(.*?)</script>', html_output, re.S):
+            self.assertNotIn('<!--', body)
+            self.assertNotIn('<script', body)
+
+    def test_passages_round_trip(self):
+        html_output = self.render()
+        blob = re.search(r'<script id="twine-passages" type="application/json">(.*?)</script>',
+                         html_output, re.S).group(1)
+        passages = json.loads(blob)
+        self.assertEqual(passages["Start"]["content"],
+                         self.HOSTILE + "\n\n[[Next->" + self.HOSTILE + "]]")
+        self.assertEqual(passages[self.HOSTILE]["content"], "Done")
+
+    def test_engine_follows_passages(self):
+        html_output = self.render()
+        self.assertEqual(html_output.count('</script>'), 3)
+        self.assertIn('const GRADING_CONFIG = {"enabled":true,"conceptPoints":{"Clue \\u003c!--', html_output)
+
+
+if __name__ == "__main__":
+    unittest.main()
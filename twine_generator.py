@@ -7,13 +7,22 @@ become the protagonist and must apply knowledge from case studies and source mat
 Features multiple decision chains per concept with cause-and-effect consequences.
 """
 
+import functools
+import hashlib
 import html
+import io
 import json
+import logging
 import uuid
 import re
 import os
 import argparse
+import asyncio
 import random
+import sys
+import time
+import types
+from itertools import islice
 from dataclasses import dataclass, field
 from typing import Optional
 from pathlib import Path
@@ -25,6 +34,40 @@ try:
 except ImportError:
     ANTHROPIC_AVAILABLE = False
 
+CLAUDE_MODEL = "claude-sonnet-4-20250514"
+CLAUDE_MAX_TOKENS = 12000
+
+# Prompt budgets for instructor-supplied material (estimated at ~4 characters per token)
+_CHARS_PER_TOKEN = 4
+SOURCE_TOKEN_BUDGET = 5000
+CASE_STUDY_TOKEN_BUDGET = 3750
+
+_SYSTEM_PROMPT = ("You are an EdQuest scenario author. You turn course materials into "
+                  "immersive, branching educational scenarios that assess how well students "
+                  "apply key concepts.")
+
+# Optional orjson import - faster parsing of content files and AI responses when installed
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# Optional pyahocorasick import - single-pass theme keyword matching when installed
+try:
+    import ahocorasick
+    AHOCORASICK_AVAILABLE = True
+except ImportError:
+    AHOCORASICK_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+_uuid4 = uuid.uuid4
+
+# Shared RNG for choice ordering
+_rng = random.Random()
+_shuffle = _rng.shuffle
+
 
 @dataclass
 class Choice:
@@ -46,8 +89,6 @@ class Passage:
     content: str
     choices: list[Choice] = field(default_factory=list)
     tags: list[str] = field(default_factory=list)
-    position_x: int = 100
-    position_y: int = 100
 
     def get_full_content(self) -> str:
         """Get passage content with choices appended."""
@@ -79,12 +120,17 @@ class TwineStory:
 
     def __post_init__(self):
         if self.ifid is None:
-            self.ifid = str(uuid.uuid4()).upper()
+            # Twine 2 requires the hyphenated UUID form, so .hex is not an option
+            self.ifid = str(_uuid4()).upper()
 
     def add_passage(self, passage: Passage) -> None:
         """Add a passage to the story."""
         self.passages.append(passage)
 
+    def extend_passages(self, passages: list[Passage]) -> None:
+        """Add several passages to the story at once."""
+        self.passages.extend(passages)
+
     def get_start_passage_index(self) -> int:
         """Get the index of the starting passage (1-based for Twine)."""
         if not self.passages:
@@ -97,18 +143,13 @@ class TwineStory:
 
     def generate_html(self) -> str:
         """Generate complete Twine 2 HTML file."""
-        passage_elements = []
-        for i, passage in enumerate(self.passages, start=1):
-            tags = " ".join(passage.tags) if passage.tags else ""
-            content = html.escape(passage.get_full_content())
-            passage_html = (
-                f'<tw-passagedata pid="{i}" name="{html.escape(passage.name)}" '
-                f'tags="{html.escape(tags)}" position="{passage.position_x},{passage.position_y}" '
-                f'size="100,100">{content}</tw-passagedata>'
-            )
-            passage_elements.append(passage_html)
+        buf = io.StringIO()
+        self.stream_html(buf)
+        return buf.getvalue()
 
-        passages_html = "\n".join(passage_elements)
+    def stream_html(self, fileobj) -> None:
+        """Write the complete Twine 2 HTML file to fileobj, one passage at a time."""
+        write = fileobj.write
         start_node = self.get_start_passage_index()
 
         grading_script = ""
@@ -119,47 +160,83 @@ class TwineStory:
                 "passingThreshold": self.grading.passing_threshold,
                 "totalPoints": self.grading.total_points,
                 "passingPoints": self.grading.passing_points
-            })
+            }, separators=(",", ":"), ensure_ascii=False).replace("<", "\\u003c")
             grading_script = f"const GRADING_CONFIG = {grading_json};"
         else:
             grading_script = "const GRADING_CONFIG = {enabled: false};"
 
-        html_output = f'''<!DOCTYPE html>
+        css = _CSS_MIN if MINIFY else _CSS_RAW
+        engine = _ENGINE_MIN if MINIFY else HARLOWE_ENGINE
+
+        write(f'''<!DOCTYPE html>
 <html>
 <head>
 <meta charset="utf-8">
 <title>{html.escape(self.title)}</title>
-<style>
-body {{
+<style>{css}</style>
+</head>
+<body>
+<tw-storydata name="{html.escape(self.title)}" startnode="{start_node}" creator="EdQuest"
+creator-version="2.0.0" ifid="{self.ifid}" zoom="1" format="Harlowe" format-version="3.3.9"
+options="" tags="" hidden>
+<style role="stylesheet" id="twine-user-stylesheet" type="text/twine-css"></style>
+<script role="script" id="twine-user-script" type="text/twine-javascript"></script>
+</tw-storydata>
+<script id="twine-passages" type="application/json">{{''')
+
+        # Passages ship as one JSON object so the engine can JSON.parse them
+        # instead of walking and entity-decoding <tw-passagedata> elements.
+        # Every "<" is written as \u003c so passage text such as "</script>" or
+        # "<!--<script>" cannot close the element or change how it is tokenized.
+        sep = ""
+        for i, passage in enumerate(self.passages, start=1):
+            entry = json.dumps(
+                {"pid": i, "content": passage.get_full_content(), "tags": passage.tags},
+                separators=(",", ":")
+            )
+            write(f"{sep}{json.dumps(passage.name)}:{entry}".replace("<", "\\u003c"))
+            sep = ","
+
+        write(f'''}}</script>
+<script>
+{grading_script}
+{engine}
+</script>
+</body>
+</html>''')
+
+
+_CSS_RAW = '''
+body {
     margin: 0;
     padding: 0;
     font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
     background: linear-gradient(135deg, #003366 0%, #004488 100%);
     min-height: 100vh;
-}}
-tw-story {{
+}
+tw-story {
     display: block;
     max-width: 800px;
     margin: 0 auto;
     padding: 40px 20px;
-}}
-tw-passage {{
+}
+tw-passage {
     display: block;
     background: white;
     border-radius: 16px;
     padding: 32px;
     box-shadow: 0 10px 40px rgba(0,0,0,0.2);
-}}
-tw-passage p {{
+}
+tw-passage p {
     margin: 0 0 16px 0;
     line-height: 1.7;
     color: #333;
-}}
-tw-passage p:last-child {{
+}
+tw-passage p:last-child {
     margin-bottom: 0;
-}}
+}
 /* Fixed: Choice buttons with proper text wrapping */
-tw-link {{
+tw-link {
     display: block;
     padding: 16px 20px;
     margin: 8px 0;
@@ -175,22 +252,22 @@ tw-link {{
     overflow-wrap: break-word;
     line-height: 1.4;
     border: 2px solid #FFD700;
-}}
-tw-link:hover {{
+}
+tw-link:hover {
     transform: translateY(-2px);
     box-shadow: 0 4px 12px rgba(255, 215, 0, 0.4);
     background: #FFD700;
     color: #003366;
-}}
+}
 /* Navigation buttons */
-.nav-buttons {{
+.nav-buttons {
     display: flex;
     gap: 12px;
     margin-top: 24px;
     padding-top: 16px;
     border-top: 1px solid #eee;
-}}
-.nav-btn {{
+}
+.nav-btn {
     padding: 10px 16px;
     border-radius: 6px;
     cursor: pointer;
@@ -198,85 +275,85 @@ tw-link:hover {{
     font-weight: 500;
     transition: all 0.2s;
     border: none;
-}}
-.nav-btn-back {{
+}
+.nav-btn-back {
     background: #e5e7eb;
     color: #374151;
-}}
-.nav-btn-back:hover {{
+}
+.nav-btn-back:hover {
     background: #d1d5db;
-}}
-.nav-btn-restart {{
+}
+.nav-btn-restart {
     background: #fee2e2;
     color: #dc2626;
-}}
-.nav-btn-restart:hover {{
+}
+.nav-btn-restart:hover {
     background: #fecaca;
-}}
-.scenario-context {{
+}
+.scenario-context {
     background: #f8f9fa;
     border-left: 4px solid #003366;
     padding: 16px;
     margin-bottom: 20px;
     border-radius: 0 8px 8px 0;
-}}
-.character-dialogue {{
+}
+.character-dialogue {
     background: #e8f4f8;
     border-left: 4px solid #17a2b8;
     padding: 16px;
     margin: 16px 0;
     border-radius: 0 8px 8px 0;
     font-style: italic;
-}}
-.character-name {{
+}
+.character-name {
     font-weight: bold;
     color: #0c5460;
     font-style: normal;
-}}
-.decision-prompt {{
+}
+.decision-prompt {
     font-weight: 600;
     color: #333;
     margin-top: 20px;
     padding-top: 16px;
     border-top: 1px solid #eee;
-}}
-.feedback-correct {{
+}
+.feedback-correct {
     background: #d4edda;
     border-left: 4px solid #28a745;
     padding: 16px;
     margin-bottom: 20px;
     border-radius: 0 8px 8px 0;
-}}
-.feedback-incorrect {{
+}
+.feedback-incorrect {
     background: #f8d7da;
     border-left: 4px solid #dc3545;
     padding: 16px;
     margin-bottom: 20px;
     border-radius: 0 8px 8px 0;
-}}
-.feedback-partial {{
+}
+.feedback-partial {
     background: #fff3cd;
     border-left: 4px solid #ffc107;
     padding: 16px;
     margin-bottom: 20px;
     border-radius: 0 8px 8px 0;
-}}
-.source-reference {{
+}
+.source-reference {
     background: #fff3cd;
     border-left: 4px solid #ffc107;
     padding: 12px 16px;
     margin: 16px 0;
     border-radius: 0 8px 8px 0;
     font-size: 0.9em;
-}}
-.consequence {{
+}
+.consequence {
     background: #e2e3e5;
     border-left: 4px solid #6c757d;
     padding: 12px 16px;
     margin: 16px 0;
     border-radius: 0 8px 8px 0;
-}}
-.theme-atmosphere {{
+}
+.theme-atmosphere {
     background: linear-gradient(135deg, #fff9e6 0%, #fff3cc 100%);
     border-left: 4px solid #FFD700;
     padding: 14px 16px;
@@ -284,8 +361,8 @@ tw-link:hover {{
     border-radius: 0 8px 8px 0;
     font-style: italic;
     color: #003366;
-}}
-.points-earned {{
+}
+.points-earned {
     display: inline-block;
     background: #28a745;
     color: white;
@@ -293,8 +370,8 @@ tw-link:hover {{
     border-radius: 20px;
     font-weight: bold;
     font-size: 0.9em;
-}}
-.points-missed {{
+}
+.points-missed {
     display: inline-block;
     background: #dc2626;
     color: white;
@@ -302,8 +379,8 @@ tw-link:hover {{
     border-radius: 20px;
     font-weight: bold;
     font-size: 0.9em;
-}}
-.points-partial {{
+}
+.points-partial {
     display: inline-block;
     background: #f59e0b;
     color: white;
@@ -311,8 +388,8 @@ tw-link:hover {{
     border-radius: 20px;
     font-weight: bold;
     font-size: 0.9em;
-}}
-.score-display {{
+}
+.score-display {
     position: fixed;
     top: 20px;
     right: 20px;
@@ -322,105 +399,81 @@ tw-link:hover {{
     box-shadow: 0 4px 20px rgba(0,0,0,0.15);
     z-index: 1000;
     text-align: center;
-}}
-.score-display .label {{
+}
+.score-display .label {
     font-size: 12px;
     color: #666;
     text-transform: uppercase;
     letter-spacing: 1px;
-}}
-.score-display .value {{
+}
+.score-display .value {
     font-size: 28px;
     font-weight: bold;
     color: #003366;
-}}
-.results-box {{
+}
+.results-box {
     background: #f8f9fa;
     border-radius: 12px;
     padding: 24px;
     margin: 20px 0;
-}}
-.results-box.passed {{
+}
+.results-box.passed {
     background: linear-gradient(135deg, #d4edda 0%, #c3e6cb 100%);
-}}
-.results-box.failed {{
+}
+.results-box.failed {
     background: linear-gradient(135deg, #f8d7da 0%, #f5c6cb 100%);
-}}
-.results-score {{
+}
+.results-score {
     font-size: 48px;
     font-weight: bold;
     text-align: center;
-}}
-.results-box.passed .results-score {{ color: #28a745; }}
-.results-box.failed .results-score {{ color: #dc3545; }}
-.results-status {{
+}
+.results-box.passed .results-score { color: #28a745; }
+.results-box.failed .results-score { color: #dc3545; }
+.results-status {
     text-align: center;
     font-size: 20px;
     font-weight: 600;
     margin: 10px 0 20px;
-}}
-.concept-result {{
+}
+.concept-result {
     display: flex;
     justify-content: space-between;
     padding: 10px 14px;
     background: white;
     border-radius: 6px;
     margin-bottom: 8px;
-}}
-.concept-result.correct {{ border-left: 4px solid #28a745; }}
-.concept-result.incorrect {{ border-left: 4px solid #dc3545; }}
-.concept-result.partial {{ border-left: 4px solid #f59e0b; }}
-.chapter-header {{
+}
+.concept-result.correct { border-left: 4px solid #28a745; }
+.concept-result.incorrect { border-left: 4px solid #dc3545; }
+.concept-result.partial { border-left: 4px solid #f59e0b; }
+.chapter-header {
     background: linear-gradient(135deg, #003366 0%, #004488 100%);
     color: #FFD700;
     padding: 16px 20px;
     margin: -32px -32px 24px -32px;
     border-radius: 16px 16px 0 0;
     border-bottom: 3px solid #FFD700;
-}}
-.chapter-header h2 {{
+}
+.chapter-header h2 {
     margin: 0;
     font-size: 1.1rem;
     font-weight: 600;
-}}
-.chapter-header .chapter-num {{
+}
+.chapter-header .chapter-num {
     opacity: 0.8;
     font-size: 0.85rem;
-}}
-</style>
-</head>
-<body>
-<tw-storydata name="{html.escape(self.title)}" startnode="{start_node}" creator="EdQuest"
-creator-version="2.0.0" ifid="{self.ifid}" zoom="1" format="Harlowe" format-version="3.3.9"
-options="" tags="" hidden>
-<style role="stylesheet" id="twine-user-stylesheet" type="text/twine-css"></style>
-<script role="script" id="twine-user-script" type="text/twine-javascript"></script>
-{passages_html}
-</tw-storydata>
-<script>
-{grading_script}
-{HARLOWE_ENGINE}
-</script>
-</body>
-</html>'''
-        return html_output
+}
+'''
 
 
 HARLOWE_ENGINE = '''
 (function() {
     const storyData = document.querySelector('tw-storydata');
-    const passages = {};
+    const passages = JSON.parse(document.getElementById('twine-passages').textContent);
     const history = [];
 
-    storyData.querySelectorAll('tw-passagedata').forEach(p => {
-        passages[p.getAttribute('name')] = {
-            pid: p.getAttribute('pid'),
-            content: p.textContent,
-            tags: (p.getAttribute('tags') || '').split(' ').filter(t => t)
-        };
-    });
-
-    const startNode = storyData.getAttribute('startnode');
+    const startNode = parseInt(storyData.getAttribute('startnode'), 10);
     let startPassage = null;
     for (const [name, data] of Object.entries(passages)) {
         if (data.pid === startNode) {
@@ -457,8 +510,13 @@ HARLOWE_ENGINE = '''
         }
     }
 
+    // Evaluated once; getConceptFromPassage runs on every navigation
+    const conceptNames = Object.keys(grading.config.conceptPoints || {});
+    const AI_NAME_RE = /^C(\\d+)(Best|Partial|Poor\\d*)$/;
+    const TEMPLATE_NAME_RE = /(Correct|Incorrect|Partial)\\s+(\\d+)/;
+
     function getConceptFromPassage(passageName, passageTags) {
-        const concepts = Object.keys(grading.config.conceptPoints || {});
+        const concepts = conceptNames;
         const tags = passageTags || [];
 
         // NEW BRANCHING TREE: Check tags for concept and score info
@@ -500,7 +558,7 @@ HARLOWE_ENGINE = '''
         }
 
         // LEGACY: Match patterns like "C1Best", "C1Partial", "C1Poor0" (old AI-generated scenarios)
-        const aiMatch = passageName.match(/^C(\\d+)(Best|Partial|Poor\\d*)$/);
+        const aiMatch = passageName.match(AI_NAME_RE);
         if (aiMatch) {
             const num = parseInt(aiMatch[1]);
             const quality = aiMatch[2];
@@ -515,7 +573,7 @@ HARLOWE_ENGINE = '''
         }
 
         // LEGACY: Match patterns like "Correct 1", "Incorrect 2a", "Partial 1b" (template scenarios)
-        const templateMatch = passageName.match(/(Correct|Incorrect|Partial)\\s+(\\d+)/);
+        const templateMatch = passageName.match(TEMPLATE_NAME_RE);
         if (templateMatch) {
             const num = parseInt(templateMatch[2]);
             if (num <= concepts.length) {
@@ -534,6 +592,14 @@ HARLOWE_ENGINE = '''
     const storyEl = document.createElement('tw-story');
     document.body.appendChild(storyEl);
 
+    // One delegated listener for every passage link, instead of per-link handlers on each render
+    storyEl.addEventListener('click', e => {
+        const link = e.target.closest('tw-link');
+        if (!link) return;
+        showPassage(link.getAttribute('data-target'));
+        window.scrollTo({ top: 0, behavior: 'smooth' });
+    });
+
     function showPassage(name, addToHistory = true) {
         const passage = passages[name];
         if (!passage) {
@@ -587,11 +653,9 @@ HARLOWE_ENGINE = '''
             content = generateResultsContent();
         }
 
-        content = content.replace(/\\[\\[([^\\]]+)->([^\\]]+)\\]\\]/g, (match, text, target) => {
-            return '<tw-link data-target="' + target + '">' + text + '</tw-link>';
-        });
-        content = content.replace(/\\[\\[([^\\]]+)\\]\\]/g, (match, target) => {
-            return '<tw-link data-target="' + target + '">' + target + '</tw-link>';
+        // [[text->target]] and [[target]] in one pass; the greedy text group makes the rightmost -> the separator
+        content = content.replace(/\\[\\[(?:([^\\]]+)->)?([^\\]]+)\\]\\]/g, (match, text, target) => {
+            return '<tw-link data-target="' + target + '">' + (text || target) + '</tw-link>';
         });
 
         if (grading.enabled) {
@@ -628,13 +692,6 @@ HARLOWE_ENGINE = '''
 
         storyEl.innerHTML = '';
         storyEl.appendChild(passageEl);
-
-        passageEl.querySelectorAll('tw-link').forEach(link => {
-            link.addEventListener('click', () => {
-                showPassage(link.getAttribute('data-target'));
-                window.scrollTo({ top: 0, behavior: 'smooth' });
-            });
-        });
     }
 
     function generateResultsBox() {
@@ -753,6 +810,16 @@ HARLOWE_ENGINE = '''
 '''
 
 
+# Generated stories embed minified CSS/JS; set to False for readable output when debugging.
+MINIFY = True
+
+_CSS_MIN = re.sub(r'\s+', ' ', re.sub(r'/\*.*?\*/', '', _CSS_RAW, flags=re.S)).strip()
+_ENGINE_MIN = re.sub(r'\n\s*', '\n', HARLOWE_ENGINE).strip()
+
+# Words of 5+ letters considered by EducationalContent.extract_key_terms
+_KEY_TERM_RE = re.compile(r'\b[a-zA-Z]{5,}\b')
+
+
 @dataclass
 class ConceptWithPoints:
     """Represents a key concept with its point value."""
@@ -789,7 +856,7 @@ class EducationalContent:
         common_words = {'the', 'and', 'for', 'are', 'but', 'not', 'you', 'all', 'can', 'had', 'her',
                        'was', 'one', 'our', 'out', 'has', 'have', 'been', 'were', 'they', 'their',
                        'what', 'when', 'where', 'who', 'will', 'with', 'this', 'that', 'from', 'which'}
-        words = re.findall(r'\b[a-zA-Z]{5,}\b', self.source_content.lower())
+        words = _KEY_TERM_RE.findall(self.source_content.lower())
         word_freq = {}
         for w in words:
             if w not in common_words:
@@ -827,447 +894,344 @@ class EducationalContent:
 
     @classmethod
     def from_json_file(cls, filepath: str) -> 'EducationalContent':
-        with open(filepath, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with open(filepath, 'rb') as f:
+            data = _json_loads(f.read())
         return cls.from_dict(data)
 
 
-def get_theme_context(theme: str) -> dict:
-    """Get detailed theme context for deep integration."""
-    theme_lower = theme.lower()
-
-    theme_contexts = {
-        'space': {
-            'setting': 'aboard a deep space research vessel or space station',
-            'role': 'newly assigned crew member/specialist',
-            'atmosphere': 'The hum of life support systems fills the air. Through the viewport, stars stretch infinitely into the void.',
-            'npcs': ['Commander', 'Chief Science Officer', 'Medical Officer', 'Engineer', 'AI System'],
-            'elements': ['zero gravity', 'airlocks', 'communication delays', 'resource management', 'cosmic phenomena'],
-            'stakes': 'crew safety, mission success, survival in the void'
-        },
-        'adventure': {
-            'setting': 'an uncharted wilderness or ancient ruins',
-            'role': 'expedition leader/explorer',
-            'atmosphere': 'The unknown stretches before you, full of both promise and peril. Every decision could lead to discovery or disaster.',
-            'npcs': ['Local Guide', 'Veteran Explorer', 'Scholar', 'Team Member', 'Mysterious Stranger'],
-            'elements': ['environmental hazards', 'limited supplies', 'ancient mysteries', 'team dynamics', 'moral dilemmas'],
-            'stakes': 'team safety, discovery, ethical choices'
-        },
-        'time travel': {
-            'setting': 'various historical periods accessed through temporal displacement',
-            'role': 'temporal agent/researcher',
-            'atmosphere': 'The temporal field shimmers around you as history unfolds. Every action ripples through time.',
-            'npcs': ['Mission Control', 'Historical Figure', 'Fellow Agent', 'Local Contact', 'Temporal Guardian'],
-            'elements': ['historical accuracy', 'paradox prevention', 'cultural sensitivity', 'timeline preservation', 'ethical implications'],
-            'stakes': 'timeline integrity, historical preservation, preventing paradoxes'
-        },
-        'detective': {
-            'setting': 'crime scenes, interrogation rooms, and investigation sites',
-            'role': 'lead investigator/detective',
-            'atmosphere': 'Clues hide in plain sight. Every witness has a story, and somewhere in the details lies the truth.',
-            'npcs': ['Partner', 'Witness', 'Suspect', 'Forensic Specialist', 'Informant'],
-            'elements': ['evidence analysis', 'witness interviews', 'logical deduction', 'time pressure', 'moral gray areas'],
-            'stakes': 'justice, truth, protecting the innocent'
-        },
-        'mystery': {
-            'setting': 'crime scenes, interrogation rooms, and investigation sites',
-            'role': 'lead investigator/detective',
-            'atmosphere': 'Clues hide in plain sight. Every witness has a story, and somewhere in the details lies the truth.',
-            'npcs': ['Partner', 'Witness', 'Suspect', 'Forensic Specialist', 'Informant'],
-            'elements': ['evidence analysis', 'witness interviews', 'logical deduction', 'time pressure', 'moral gray areas'],
-            'stakes': 'justice, truth, protecting the innocent'
-        },
-        'intercultural': {
-            'setting': 'international summits, cultural exchanges, or global organizations',
-            'role': 'cultural liaison/diplomat',
-            'atmosphere': 'Diverse perspectives converge here. Understanding bridges gaps; assumptions create chasms.',
-            'npcs': ['Cultural Representative', 'Translator', 'Local Leader', 'International Colleague', 'Community Elder'],
-            'elements': ['cultural protocols', 'communication styles', 'values differences', 'relationship building', 'conflict resolution'],
-            'stakes': 'international relations, mutual understanding, peaceful cooperation'
-        },
-        'global': {
-            'setting': 'international summits, cultural exchanges, or global organizations',
-            'role': 'cultural liaison/diplomat',
-            'atmosphere': 'Diverse perspectives converge here. Understanding bridges gaps; assumptions create chasms.',
-            'npcs': ['Cultural Representative', 'Translator', 'Local Leader', 'International Colleague', 'Community Elder'],
-            'elements': ['cultural protocols', 'communication styles', 'values differences', 'relationship building', 'conflict resolution'],
-            'stakes': 'international relations, mutual understanding, peaceful cooperation'
-        },
-        'non-profit': {
-            'setting': 'community centers, field operations, or organizational headquarters',
-            'role': 'program coordinator/field worker',
-            'atmosphere': 'Resources are limited but dedication runs deep. Every decision affects real lives and communities.',
-            'npcs': ['Executive Director', 'Community Member', 'Volunteer', 'Donor Representative', 'Partner Organization Lead'],
-            'elements': ['resource allocation', 'stakeholder management', 'ethical fundraising', 'impact measurement', 'community engagement'],
-            'stakes': 'community welfare, organizational sustainability, mission integrity'
-        },
-        'ngo': {
-            'setting': 'community centers, field operations, or organizational headquarters',
-            'role': 'program coordinator/field worker',
-            'atmosphere': 'Resources are limited but dedication runs deep. Every decision affects real lives and communities.',
-            'npcs': ['Executive Director', 'Community Member', 'Volunteer', 'Donor Representative', 'Partner Organization Lead'],
-            'elements': ['resource allocation', 'stakeholder management', 'ethical fundraising', 'impact measurement', 'community engagement'],
-            'stakes': 'community welfare, organizational sustainability, mission integrity'
-        },
-        'healthcare': {
-            'setting': 'hospital wards, clinics, or medical facilities',
-            'role': 'healthcare professional (resident, nurse, specialist)',
-            'atmosphere': 'The weight of responsibility presses in. Lives hang in the balance of your expertise and judgment.',
-            'npcs': ['Attending Physician', 'Nurse', 'Patient', 'Family Member', 'Specialist Consultant'],
-            'elements': ['patient care', 'medical ethics', 'time pressure', 'team communication', 'evidence-based practice'],
-            'stakes': 'patient outcomes, ethical care, professional integrity'
-        },
-        'clinical': {
-            'setting': 'hospital wards, clinics, or medical facilities',
-            'role': 'healthcare professional (resident, nurse, specialist)',
-            'atmosphere': 'The weight of responsibility presses in. Lives hang in the balance of your expertise and judgment.',
-            'npcs': ['Attending Physician', 'Nurse', 'Patient', 'Family Member', 'Specialist Consultant'],
-            'elements': ['patient care', 'medical ethics', 'time pressure', 'team communication', 'evidence-based practice'],
-            'stakes': 'patient outcomes, ethical care, professional integrity'
-        },
-        'business': {
-            'setting': 'corporate offices, boardrooms, or business operations',
-            'role': 'manager/analyst/consultant',
-            'atmosphere': 'Competing priorities demand attention. Stakeholders watch closely as strategy meets reality.',
-            'npcs': ['Executive', 'Team Member', 'Client', 'Competitor', 'Mentor'],
-            'elements': ['strategic decisions', 'stakeholder management', 'resource constraints', 'ethical dilemmas', 'market dynamics'],
-            'stakes': 'business success, team welfare, ethical conduct'
-        },
-        'corporate': {
-            'setting': 'corporate offices, boardrooms, or business operations',
-            'role': 'manager/analyst/consultant',
-            'atmosphere': 'Competing priorities demand attention. Stakeholders watch closely as strategy meets reality.',
-            'npcs': ['Executive', 'Team Member', 'Client', 'Competitor', 'Mentor'],
-            'elements': ['strategic decisions', 'stakeholder management', 'resource constraints', 'ethical dilemmas', 'market dynamics'],
-            'stakes': 'business success, team welfare, ethical conduct'
-        },
-        'research': {
-            'setting': 'laboratories, research facilities, or field sites',
-            'role': 'research scientist/assistant',
-            'atmosphere': 'Data tells stories to those who listen carefully. Methodology separates discovery from delusion.',
-            'npcs': ['Principal Investigator', 'Lab Technician', 'Peer Researcher', 'Ethics Board Member', 'Research Subject'],
-            'elements': ['methodology', 'data integrity', 'ethical considerations', 'peer review', 'reproducibility'],
-            'stakes': 'scientific integrity, research ethics, knowledge advancement'
-        },
-        'laboratory': {
-            'setting': 'laboratories, research facilities, or field sites',
-            'role': 'research scientist/assistant',
-            'atmosphere': 'Data tells stories to those who listen carefully. Methodology separates discovery from delusion.',
-            'npcs': ['Principal Investigator', 'Lab Technician', 'Peer Researcher', 'Ethics Board Member', 'Research Subject'],
-            'elements': ['methodology', 'data integrity', 'ethical considerations', 'peer review', 'reproducibility'],
-            'stakes': 'scientific integrity, research ethics, knowledge advancement'
-        },
-        'legal': {
-            'setting': 'courtrooms, law offices, or compliance departments',
-            'role': 'attorney/paralegal/compliance officer',
-            'atmosphere': 'Precedent and principle collide. The letter of the law meets the spirit of justice.',
-            'npcs': ['Senior Partner', 'Client', 'Opposing Counsel', 'Judge', 'Witness'],
-            'elements': ['legal analysis', 'ethical obligations', 'client advocacy', 'procedural requirements', 'risk assessment'],
-            'stakes': 'justice, client welfare, professional ethics'
-        },
-        'compliance': {
-            'setting': 'courtrooms, law offices, or compliance departments',
-            'role': 'attorney/paralegal/compliance officer',
-            'atmosphere': 'Precedent and principle collide. The letter of the law meets the spirit of justice.',
-            'npcs': ['Senior Partner', 'Client', 'Opposing Counsel', 'Judge', 'Witness'],
-            'elements': ['legal analysis', 'ethical obligations', 'client advocacy', 'procedural requirements', 'risk assessment'],
-            'stakes': 'justice, client welfare, professional ethics'
-        },
-        'educational': {
-            'setting': 'classrooms, schools, or educational institutions',
-            'role': 'teacher/administrator/counselor',
-            'atmosphere': 'Young minds look to you for guidance. Every interaction shapes futures.',
-            'npcs': ['Principal', 'Student', 'Parent', 'Colleague Teacher', 'Counselor'],
-            'elements': ['pedagogical methods', 'student needs', 'classroom management', 'assessment', 'equity considerations'],
-            'stakes': 'student success, educational equity, professional growth'
-        },
-        'teaching': {
-            'setting': 'classrooms, schools, or educational institutions',
-            'role': 'teacher/administrator/counselor',
-            'atmosphere': 'Young minds look to you for guidance. Every interaction shapes futures.',
-            'npcs': ['Principal', 'Student', 'Parent', 'Colleague Teacher', 'Counselor'],
-            'elements': ['pedagogical methods', 'student needs', 'classroom management', 'assessment', 'equity considerations'],
-            'stakes': 'student success, educational equity, professional growth'
-        },
-        'technical': {
-            'setting': 'engineering facilities, tech companies, or project sites',
-            'role': 'engineer/developer/technical lead',
-            'atmosphere': 'Complex systems demand precision. Innovation pushes boundaries while safety sets limits.',
-            'npcs': ['Project Manager', 'Senior Engineer', 'QA Specialist', 'Client Representative', 'Team Member'],
-            'elements': ['technical constraints', 'safety requirements', 'innovation vs risk', 'team collaboration', 'deadline pressure'],
-            'stakes': 'project success, safety, technical excellence'
-        },
-        'engineering': {
-            'setting': 'engineering facilities, tech companies, or project sites',
-            'role': 'engineer/developer/technical lead',
-            'atmosphere': 'Complex systems demand precision. Innovation pushes boundaries while safety sets limits.',
-            'npcs': ['Project Manager', 'Senior Engineer', 'QA Specialist', 'Client Representative', 'Team Member'],
-            'elements': ['technical constraints', 'safety requirements', 'innovation vs risk', 'team collaboration', 'deadline pressure'],
-            'stakes': 'project success, safety, technical excellence'
-        }
-    }
-
-    # Find matching theme context
-    for key, context in theme_contexts.items():
+# Theme contexts are shared by every caller, so they are read-only all the way down
+# (mapping proxies with tuple values)
+_CANONICAL_CONTEXTS: types.MappingProxyType = types.MappingProxyType({
+    'space': types.MappingProxyType({
+        'setting': 'aboard a deep space research vessel or space station',
+        'role': 'newly assigned crew member/specialist',
+        'atmosphere': 'The hum of life support systems fills the air. Through the viewport, stars stretch infinitely into the void.',
+        'npcs': ('Commander', 'Chief Science Officer', 'Medical Officer', 'Engineer', 'AI System'),
+        'elements': ('zero gravity', 'airlocks', 'communication delays', 'resource management', 'cosmic phenomena'),
+        'stakes': 'crew safety, mission success, survival in the void'
+    }),
+    'adventure': types.MappingProxyType({
+        'setting': 'an uncharted wilderness or ancient ruins',
+        'role': 'expedition leader/explorer',
+        'atmosphere': 'The unknown stretches before you, full of both promise and peril. Every decision could lead to discovery or disaster.',
+        'npcs': ('Local Guide', 'Veteran Explorer', 'Scholar', 'Team Member', 'Mysterious Stranger'),
+        'elements': ('environmental hazards', 'limited supplies', 'ancient mysteries', 'team dynamics', 'moral dilemmas'),
+        'stakes': 'team safety, discovery, ethical choices'
+    }),
+    'time travel': types.MappingProxyType({
+        'setting': 'various historical periods accessed through temporal displacement',
+        'role': 'temporal agent/researcher',
+        'atmosphere': 'The temporal field shimmers around you as history unfolds. Every action ripples through time.',
+        'npcs': ('Mission Control', 'Historical Figure', 'Fellow Agent', 'Local Contact', 'Temporal Guardian'),
+        'elements': ('historical accuracy', 'paradox prevention', 'cultural sensitivity', 'timeline preservation', 'ethical implications'),
+        'stakes': 'timeline integrity, historical preservation, preventing paradoxes'
+    }),
+    'detective': types.MappingProxyType({
+        'setting': 'crime scenes, interrogation rooms, and investigation sites',
+        'role': 'lead investigator/detective',
+        'atmosphere': 'Clues hide in plain sight. Every witness has a story, and somewhere in the details lies the truth.',
+        'npcs': ('Partner', 'Witness', 'Suspect', 'Forensic Specialist', 'Informant'),
+        'elements': ('evidence analysis', 'witness interviews', 'logical deduction', 'time pressure', 'moral gray areas'),
+        'stakes': 'justice, truth, protecting the innocent'
+    }),
+    'intercultural': types.MappingProxyType({
+        'setting': 'international summits, cultural exchanges, or global organizations',
+        'role': 'cultural liaison/diplomat',
+        'atmosphere': 'Diverse perspectives converge here. Understanding bridges gaps; assumptions create chasms.',
+        'npcs': ('Cultural Representative', 'Translator', 'Local Leader', 'International Colleague', 'Community Elder'),
+        'elements': ('cultural protocols', 'communication styles', 'values differences', 'relationship building', 'conflict resolution'),
+        'stakes': 'international relations, mutual understanding, peaceful cooperation'
+    }),
+    'non-profit': types.MappingProxyType({
+        'setting': 'community centers, field operations, or organizational headquarters',
+        'role': 'program coordinator/field worker',
+        'atmosphere': 'Resources are limited but dedication runs deep. Every decision affects real lives and communities.',
+        'npcs': ('Executive Director', 'Community Member', 'Volunteer', 'Donor Representative', 'Partner Organization Lead'),
+        'elements': ('resource allocation', 'stakeholder management', 'ethical fundraising', 'impact measurement', 'community engagement'),
+        'stakes': 'community welfare, organizational sustainability, mission integrity'
+    }),
+    'healthcare': types.MappingProxyType({
+        'setting': 'hospital wards, clinics, or medical facilities',
+        'role': 'healthcare professional (resident, nurse, specialist)',
+        'atmosphere': 'The weight of responsibility presses in. Lives hang in the balance of your expertise and judgment.',
+        'npcs': ('Attending Physician', 'Nurse', 'Patient', 'Family Member', 'Specialist Consultant'),
+        'elements': ('patient care', 'medical ethics', 'time pressure', 'team communication', 'evidence-based practice'),
+        'stakes': 'patient outcomes, ethical care, professional integrity'
+    }),
+    'business': types.MappingProxyType({
+        'setting': 'corporate offices, boardrooms, or business operations',
+        'role': 'manager/analyst/consultant',
+        'atmosphere': 'Competing priorities demand attention. Stakeholders watch closely as strategy meets reality.',
+        'npcs': ('Executive', 'Team Member', 'Client', 'Competitor', 'Mentor'),
+        'elements': ('strategic decisions', 'stakeholder management', 'resource constraints', 'ethical dilemmas', 'market dynamics'),
+        'stakes': 'business success, team welfare, ethical conduct'
+    }),
+    'research': types.MappingProxyType({
+        'setting': 'laboratories, research facilities, or field sites',
+        'role': 'research scientist/assistant',
+        'atmosphere': 'Data tells stories to those who listen carefully. Methodology separates discovery from delusion.',
+        'npcs': ('Principal Investigator', 'Lab Technician', 'Peer Researcher', 'Ethics Board Member', 'Research Subject'),
+        'elements': ('methodology', 'data integrity', 'ethical considerations', 'peer review', 'reproducibility'),
+        'stakes': 'scientific integrity, research ethics, knowledge advancement'
+    }),
+    'legal': types.MappingProxyType({
+        'setting': 'courtrooms, law offices, or compliance departments',
+        'role': 'attorney/paralegal/compliance officer',
+        'atmosphere': 'Precedent and principle collide. The letter of the law meets the spirit of justice.',
+        'npcs': ('Senior Partner', 'Client', 'Opposing Counsel', 'Judge', 'Witness'),
+        'elements': ('legal analysis', 'ethical obligations', 'client advocacy', 'procedural requirements', 'risk assessment'),
+        'stakes': 'justice, client welfare, professional ethics'
+    }),
+    'educational': types.MappingProxyType({
+        'setting': 'classrooms, schools, or educational institutions',
+        'role': 'teacher/administrator/counselor',
+        'atmosphere': 'Young minds look to you for guidance. Every interaction shapes futures.',
+        'npcs': ('Principal', 'Student', 'Parent', 'Colleague Teacher', 'Counselor'),
+        'elements': ('pedagogical methods', 'student needs', 'classroom management', 'assessment', 'equity considerations'),
+        'stakes': 'student success, educational equity, professional growth'
+    }),
+    'technical': types.MappingProxyType({
+        'setting': 'engineering facilities, tech companies, or project sites',
+        'role': 'engineer/developer/technical lead',
+        'atmosphere': 'Complex systems demand precision. Innovation pushes boundaries while safety sets limits.',
+        'npcs': ('Project Manager', 'Senior Engineer', 'QA Specialist', 'Client Representative', 'Team Member'),
+        'elements': ('technical constraints', 'safety requirements', 'innovation vs risk', 'team collaboration', 'deadline pressure'),
+        'stakes': 'project success, safety, technical excellence'
+    })
+})
+
+# Alternative keywords that share a canonical theme's context
+_THEME_ALIASES: types.MappingProxyType = types.MappingProxyType({
+    'mystery': 'detective',
+    'global': 'intercultural',
+    'ngo': 'non-profit',
+    'clinical': 'healthcare',
+    'corporate': 'business',
+    'laboratory': 'research',
+    'compliance': 'legal',
+    'teaching': 'educational',
+    'engineering': 'technical'
+})
+
+# Keyword -> context in match priority order (each canonical theme followed by its aliases).
+# Contexts are shared references, so aliases cost no extra storage.
+_THEME_KEYWORDS: types.MappingProxyType = types.MappingProxyType({
+    keyword: context
+    for canonical, context in _CANONICAL_CONTEXTS.items()
+    for keyword in (canonical, *[alias for alias, target in _THEME_ALIASES.items() if target == canonical])
+})
+
+
+def _build_theme_automaton():
+    """Build an Aho-Corasick automaton over all theme keywords, valued (priority, context)."""
+    automaton = ahocorasick.Automaton()
+    for priority, (keyword, context) in enumerate(_THEME_KEYWORDS.items()):
+        automaton.add_word(keyword, (priority, context))
+    automaton.make_automaton()
+    return automaton
+
+
+_THEME_AUTOMATON = _build_theme_automaton() if AHOCORASICK_AVAILABLE else None
+
+# Default generic context for themes that match none of the above
+_DEFAULT_THEME_CONTEXT = types.MappingProxyType({
+    'setting': 'a professional environment',
+    'role': 'a key decision-maker',
+    'atmosphere': 'The situation demands your full attention and expertise.',
+    'npcs': ('Supervisor', 'Colleague', 'Client', 'Expert', 'Stakeholder'),
+    'elements': ('critical decisions', 'stakeholder interests', 'ethical considerations', 'time pressure', 'resource constraints'),
+    'stakes': 'success, integrity, relationships'
+})
+
+
+@functools.lru_cache(maxsize=128)
+def get_theme_context(theme: str) -> types.MappingProxyType:
+    """Get detailed theme context for deep integration (read-only, cached per theme)."""
+    return _match_theme_context(theme.lower().strip())
+
+
+def _match_theme_context(theme_lower: str) -> types.MappingProxyType:
+    """Resolve a normalized theme to its (shared, read-only) context."""
+    # Canonical names ("healthcare", "business") are the common case: one hash lookup.
+    # No keyword contains a higher-priority keyword, so this agrees with the scan.
+    context = _THEME_KEYWORDS.get(theme_lower)
+    if context is not None:
+        return context
+
+    if _THEME_AUTOMATON is not None:
+        # One pass finds every keyword; the highest-priority one wins, as in the scan below
+        best = min((match for _, match in _THEME_AUTOMATON.iter(theme_lower)), default=None)
+        return best[1] if best else _DEFAULT_THEME_CONTEXT
+
+    # First keyword contained in the theme wins
+    for key, context in _THEME_KEYWORDS.items():
         if key in theme_lower:
             return context
-
-    # Default generic context
-    return {
-        'setting': 'a professional environment',
-        'role': 'a key decision-maker',
-        'atmosphere': 'The situation demands your full attention and expertise.',
-        'npcs': ['Supervisor', 'Colleague', 'Client', 'Expert', 'Stakeholder'],
-        'elements': ['critical decisions', 'stakeholder interests', 'ethical considerations', 'time pressure', 'resource constraints'],
-        'stakes': 'success, integrity, relationships'
-    }
+    return _DEFAULT_THEME_CONTEXT
 
 
-def generate_scenario_with_ai(content: EducationalContent, api_key: str,
-                               decision_nodes: int = 4, branches_per_node: int = 3,
-                               case_study_mode: bool = False, case_study: dict = None,
-                               custom_scenario_description: str = None) -> dict:
+def _truncate_to_tokens(text: str, budget: int, marker: str) -> str:
     """
-    Use Claude AI to generate an application-focused educational scenario
-    with concise text and non-obvious choices that require critical thinking.
+    Trim text to roughly `budget` prompt tokens, appending marker when cut.
+    Uses a local chars-per-token estimate; exact counting would cost an extra API round trip.
     """
-    if not ANTHROPIC_AVAILABLE:
-        raise RuntimeError("anthropic package not installed. Run: pip install anthropic")
-
-    client = anthropic.Anthropic(api_key=api_key)
-
-    # Get theme context
-    theme_context = get_theme_context(content.theme)
-
-    # Build the prompt for Claude
-    concepts_list = "\n".join(f"- {c.name} ({c.points} points)" for c in content.key_concepts)
-    objectives_list = "\n".join(f"- {obj}" for obj in content.learning_objectives)
-
-    # Prepare source content
-    source_text = content.source_content
-    if len(source_text) > 20000:
-        source_text = source_text[:20000] + "\n\n[Content truncated...]"
-
-    # Prepare custom scenario description if provided
-    custom_scenario_section = ""
-    if custom_scenario_description:
-        custom_scenario_section = f"""
-## CUSTOM SCENARIO DESCRIPTION (PRIMARY SOURCE - BUILD SCENARIO AROUND THIS)
-
-{custom_scenario_description}
-
-CRITICAL: The scenario MUST be built around this custom description. Use the specific:
-- Setting, location, and environment described
-- Characters, roles, and relationships mentioned
-- Situation, context, and circumstances outlined
-- Any specific details the instructor provided
-The student should experience EXACTLY the scenario described above. Do NOT substitute generic elements.
-"""
-
-    # Prepare case study content if provided
-    case_study_section = ""
-    if case_study_mode and case_study:
-        case_study_content = case_study.get('content', '')
-        if len(case_study_content) > 15000:
-            case_study_content = case_study_content[:15000] + "\n\n[Truncated...]"
-        case_study_section = f"""
-## CASE STUDY (PRIMARY SOURCE - BUILD SCENARIO AROUND THIS)
-Title: {case_study.get('title', 'Case Study')}
-
-{case_study_content}
-
-CRITICAL: The scenario MUST be built around this case study. Use its specific:
-- Characters, names, and roles
-- Situations and events described
-- Organizations and context
-- Actual dilemmas and decisions faced
-The student should feel they are living INSIDE this case, making the real decisions.
-"""
-
-    # Calculate branching depth based on decision_nodes
-    # With true branching, we need a tree structure
-    # depth 1 = root decision, depth 2 = second level, etc.
-    branching_depth = min(decision_nodes, 3)  # Cap at 3 levels to keep content manageable
-
-    prompt = f"""You are creating a TRUE BRANCHING NARRATIVE educational scenario. This is NOT a linear quiz - student choices must lead to GENUINELY DIFFERENT paths and outcomes.
-
-## CRITICAL: TRUE BRANCHING STRUCTURE
-
-This scenario must be a BRANCHING TREE, not a linear sequence:
-- Each choice leads to a DIFFERENT situation (not the same next question)
-- Different paths have DIFFERENT events, challenges, and outcomes
-- Poor early choices should lead to increasingly difficult situations
-- Good early choices should open up better opportunities
-- The narrative should DIVERGE based on choices, not converge
-
-Example of WRONG (linear) structure:
-  Decision 1 → [all paths] → Decision 2 → [all paths] → Decision 3 → End
-
-Example of CORRECT (branching) structure:
-  Decision 1
-  ├── Choice A → Situation A → Decision 2A → [branches to different endings]
-  ├── Choice B → Situation B → Decision 2B → [branches to different endings]
-  └── Choice C → Situation C → Decision 2C → [branches to different endings]
-
-## DESIGN PRINCIPLES
+    limit = budget * _CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    return text[:limit] + marker
 
-### 1. MEANINGFUL BRANCHING
-- Each choice should lead to a narratively DIFFERENT situation
-- If you choose to confront someone vs. avoid them, the next scene should be COMPLETELY DIFFERENT
-- Choices have CONSEQUENCES that shape the rest of the story
-- Students should feel their choices MATTER
-
-### 2. ALL CHOICES MUST SOUND REASONABLE
-- Every choice should sound like something a thoughtful professional might consider
-- Wrong choices reflect common misconceptions, not obvious mistakes
-- A student who hasn't studied should find all options equally plausible
-- NO choices like "ignore the problem" or "do nothing"
 
-### 3. CONSEQUENCES SNOWBALL
-- Early optimal choices → easier subsequent situations → better endings
-- Early poor choices → harder subsequent situations → worse endings
-- But EVERY path should be interesting and educational
+def _build_course_materials(content: EducationalContent) -> str:
+    """Build the course-materials block shared by every prompt for this content."""
+    concepts_list = "\n".join(["- %s (%s points)" % (c.name, c.points) for c in content.key_concepts])
+    objectives_list = "\n".join(["- %s" % obj for obj in content.learning_objectives])
 
-### 4. MULTIPLE ENDINGS
-- Each concept should have {branches_per_node} to {branches_per_node * 2} possible endings
-- Endings vary from "excellent application" (full points) to "needs review" (minimal points)
-- Each ending should explain what the student's path demonstrated
+    source_text = _truncate_to_tokens(content.source_content, SOURCE_TOKEN_BUDGET,
+                                      "\n\n[Content truncated...]")
 
-## Theme: {content.theme}
-- Setting: {theme_context['setting']}
-- Student Role: {theme_context['role']}
-- Stakes: {theme_context['stakes']}
-{custom_scenario_section}{case_study_section}
-## SUPPLEMENTARY MATERIALS
+    return f"""## SUPPLEMENTARY MATERIALS
 {source_text if source_text else "(No additional materials provided)"}
 
 ## Learning Objectives
 {objectives_list}
 
 ## Key Concepts to Assess
-{concepts_list}
+{concepts_list}"""
 
-## BRANCHING STRUCTURE REQUIREMENTS
 
-Create {len(content.key_concepts)} chapters, one per concept. Each chapter is a BRANCHING TREE:
-- Depth: {branching_depth} levels of decisions
-- Branches: {branches_per_node} choices at each decision point
-- Each branch leads to a UNIQUE next situation
-- Multiple endings per chapter (ranging from optimal to poor outcomes)
+def _build_scenario_request(content: EducationalContent, **options) -> dict:
+    """
+    Build the messages.create arguments for a scenario.
 
-## JSON OUTPUT FORMAT - BRANCHING TREE STRUCTURE
+    The course materials go in a cache_control'd system block so repeat
+    generations for the same content reuse Anthropic's prompt cache; only the
+    user message varies between calls. (Blocks under the model's minimum
+    cacheable size are simply not cached.)
+    """
+    return {
+        "system": [
+            {"type": "text", "text": _SYSTEM_PROMPT},
+            {"type": "text", "text": _build_course_materials(content),
+             "cache_control": {"type": "ephemeral"}}
+        ],
+        "messages": [
+            {"role": "user", "content": _build_scenario_prompt(content, **options)}
+        ]
+    }
 
-Return ONLY valid JSON with this TREE structure:
 
-{{
-  "introduction": {{
+# Example of the JSON tree Claude must return; static, so kept out of the prompt f-strings
+_BRANCHING_SCHEMA = """Return ONLY valid JSON with this TREE structure:
+
+{
+  "introduction": {
     "opening_narrative": "1-2 paragraphs immersing the student in the scenario. Vivid setting, clear role, atmospheric.",
     "role": "Student's specific role",
     "stakes": "What's at stake"
-  }},
+  },
   "chapters": [
-    {{
+    {
       "concept": "Concept name being tested",
       "title": "Chapter title",
       "setup": "Brief transition to this chapter's situation",
-      "branch_tree": {{
-        "root": {{
+      "branch_tree": {
+        "root": {
           "node_id": "root",
           "situation": "2-3 sentences describing the situation the student faces",
           "choices": [
-            {{
+            {
               "text": "Action description (max 60 chars)",
               "quality": "optimal",
               "leads_to": "node_a",
               "transition": "1-2 sentences describing immediate consequence and transition"
-            }},
-            {{
+            },
+            {
               "text": "Action description (max 60 chars)",
               "quality": "adequate",
               "leads_to": "node_b",
               "transition": "1-2 sentences describing immediate consequence and transition"
-            }},
-            {{
+            },
+            {
               "text": "Action description (max 60 chars)",
               "quality": "poor",
               "leads_to": "node_c",
               "transition": "1-2 sentences describing immediate consequence and transition"
-            }}
+            }
           ]
-        }},
-        "node_a": {{
+        },
+        "node_a": {
           "node_id": "node_a",
           "situation": "NEW situation resulting from optimal choice - different from node_b and node_c",
           "choices": [
-            {{
+            {
               "text": "Action (max 60 chars)",
               "quality": "optimal",
               "leads_to": "ending_excellent",
               "transition": "Consequence leading to ending"
-            }},
-            {{
+            },
+            {
               "text": "Action (max 60 chars)",
               "quality": "adequate",
               "leads_to": "ending_good",
               "transition": "Consequence leading to ending"
-            }},
-            {{
+            },
+            {
               "text": "Action (max 60 chars)",
               "quality": "poor",
               "leads_to": "ending_mixed_a",
               "transition": "Consequence leading to ending"
-            }}
+            }
           ]
-        }},
-        "node_b": {{
+        },
+        "node_b": {
           "node_id": "node_b",
           "situation": "DIFFERENT situation resulting from adequate choice",
           "choices": [
-            {{
+            {
               "text": "Action (max 60 chars)",
               "quality": "optimal",
               "leads_to": "ending_good",
               "transition": "Consequence"
-            }},
-            {{
+            },
+            {
               "text": "Action (max 60 chars)",
               "quality": "adequate",
               "leads_to": "ending_mixed_b",
               "transition": "Consequence"
-            }},
-            {{
+            },
+            {
               "text": "Action (max 60 chars)",
               "quality": "poor",
               "leads_to": "ending_poor",
               "transition": "Consequence"
-            }}
+            }
           ]
-        }},
-        "node_c": {{
+        },
+        "node_c": {
           "node_id": "node_c",
           "situation": "DIFFICULT situation resulting from poor initial choice",
           "choices": [
-            {{
+            {
               "text": "Recovery action (max 60 chars)",
               "quality": "optimal",
               "leads_to": "ending_mixed_c",
               "transition": "Partial recovery"
-            }},
-            {{
+            },
+            {
               "text": "Action (max 60 chars)",
               "quality": "adequate",
               "leads_to": "ending_poor",
               "transition": "Consequence"
-            }},
-            {{
+            },
+            {
               "text": "Action (max 60 chars)",
               "quality": "poor",
               "leads_to": "ending_fail",
               "transition": "Consequence"
-            }}
+            }
           ]
-        }},
-        "ending_excellent": {{
+        },
+        "ending_excellent": {
           "node_id": "ending_excellent",
           "is_ending": true,
           "score_percent": 100,
@@ -1275,8 +1239,8 @@ Return ONLY valid JSON with this TREE structure:
           "narrative": "2-3 sentences describing the successful outcome",
           "feedback": "Explanation of why this path demonstrated mastery of the concept",
           "concept_demonstrated": "How the student showed understanding"
-        }},
-        "ending_good": {{
+        },
+        "ending_good": {
           "node_id": "ending_good",
           "is_ending": true,
           "score_percent": 80,
@@ -1284,8 +1248,8 @@ Return ONLY valid JSON with this TREE structure:
           "narrative": "Outcome description",
           "feedback": "What went well and what could improve",
           "concept_demonstrated": "Partial application shown"
-        }},
-        "ending_mixed_a": {{
+        },
+        "ending_mixed_a": {
           "node_id": "ending_mixed_a",
           "is_ending": true,
           "score_percent": 60,
@@ -1293,8 +1257,8 @@ Return ONLY valid JSON with this TREE structure:
           "narrative": "Outcome with some issues",
           "feedback": "Analysis of the path taken",
           "concept_demonstrated": "Gaps in application"
-        }},
-        "ending_mixed_b": {{
+        },
+        "ending_mixed_b": {
           "node_id": "ending_mixed_b",
           "is_ending": true,
           "score_percent": 50,
@@ -1302,8 +1266,8 @@ Return ONLY valid JSON with this TREE structure:
           "narrative": "Outcome description",
           "feedback": "What was missing",
           "concept_demonstrated": "Limited demonstration"
-        }},
-        "ending_mixed_c": {{
+        },
+        "ending_mixed_c": {
           "node_id": "ending_mixed_c",
           "is_ending": true,
           "score_percent": 40,
@@ -1311,8 +1275,8 @@ Return ONLY valid JSON with this TREE structure:
           "narrative": "Recovered from poor start",
           "feedback": "Good recovery but early mistake cost points",
           "concept_demonstrated": "Eventually showed understanding"
-        }},
-        "ending_poor": {{
+        },
+        "ending_poor": {
           "node_id": "ending_poor",
           "is_ending": true,
           "score_percent": 25,
@@ -1320,8 +1284,8 @@ Return ONLY valid JSON with this TREE structure:
           "narrative": "Problematic outcome",
           "feedback": "Key concepts were not properly applied",
           "concept_demonstrated": "Review needed"
-        }},
-        "ending_fail": {{
+        },
+        "ending_fail": {
           "node_id": "ending_fail",
           "is_ending": true,
           "score_percent": 0,
@@ -1329,186 +1293,426 @@ Return ONLY valid JSON with this TREE structure:
           "narrative": "Poor outcome requiring review",
           "feedback": "The approach taken did not apply the concept correctly",
           "concept_demonstrated": "Concept review strongly recommended"
-        }}
-      }}
-    }}
+        }
+      }
+    }
   ],
-  "conclusion": {{
+  "conclusion": {
     "high_score": "Congratulations message",
     "medium_score": "Encouragement message",
     "low_score": "Review suggestion"
-  }}
-}}
+  }
+}
+"""
 
-## CRITICAL REQUIREMENTS
 
-1. Each node_id must be UNIQUE within the chapter
-2. Every "leads_to" must reference an existing node_id
-3. Decision nodes have "choices" array; ending nodes have "is_ending": true
-4. Situations in different branches must be NARRATIVELY DIFFERENT
-5. All choice text must be professional-sounding (max 60 chars)
-6. Endings should range from 100% (excellent) to 0% (needs review)
-7. Create {branches_per_node * 2} to {branches_per_node * 3} unique endings per concept
-8. The tree must have {branching_depth} levels of decisions before reaching endings
+@functools.lru_cache(maxsize=64)
+def _build_base_prompt(theme: str, concept_count: int,
+                       decision_nodes: int, branches_per_node: int) -> tuple[str, str]:
+    """
+    Build the static parts of the scenario prompt, i.e. the text before and after
+    the per-call custom scenario / case study sections. Cached per
+    (theme, concept count, structure) so repeat generations skip re-rendering it.
+    """
+    theme_context = get_theme_context(theme)
 
-Return ONLY valid JSON."""
+    # Calculate branching depth based on decision_nodes
+    # With true branching, we need a tree structure
+    # depth 1 = root decision, depth 2 = second level, etc.
+    branching_depth = min(decision_nodes, 3)  # Cap at 3 levels to keep content manageable
 
-    # DEBUG: Log the prompt being sent to Claude
-    print("\n" + "="*60)
-    print("DEBUG: Prompt being sent to Claude AI")
-    print("="*60)
-    print(f"Custom Scenario Section Present: {'Yes' if custom_scenario_section else 'No'}")
-    print(f"Case Study Section Present: {'Yes' if case_study_section else 'No'}")
-    if custom_scenario_section:
-        print("\n--- CUSTOM SCENARIO SECTION CONTENT ---")
-        print(custom_scenario_section[:500])
-        print("--- END PREVIEW ---\n")
-    print("="*60 + "\n")
+    head = f"""You are creating a TRUE BRANCHING NARRATIVE educational scenario. This is NOT a linear quiz - student choices must lead to GENUINELY DIFFERENT paths and outcomes.
 
-    try:
-        message = client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=12000,
-            messages=[
-                {"role": "user", "content": prompt}
-            ]
-        )
+## CRITICAL: TRUE BRANCHING STRUCTURE
 
-        response_text = message.content[0].text
+This scenario must be a BRANCHING TREE, not a linear sequence:
+- Each choice leads to a DIFFERENT situation (not the same next question)
+- Different paths have DIFFERENT events, challenges, and outcomes
+- Poor early choices should lead to increasingly difficult situations
+- Good early choices should open up better opportunities
+- The narrative should DIVERGE based on choices, not converge
 
-        # Try to extract JSON from response
-        json_match = re.search(r'\{[\s\S]*\}', response_text)
-        if json_match:
-            scenario_data = json.loads(json_match.group())
-            return scenario_data
-        else:
-            raise ValueError("No valid JSON found in AI response")
+Example of WRONG (linear) structure:
+  Decision 1 → [all paths] → Decision 2 → [all paths] → Decision 3 → End
 
-    except json.JSONDecodeError as e:
-        raise ValueError(f"Failed to parse AI response as JSON: {e}")
-    except anthropic.APIError as e:
-        raise RuntimeError(f"Claude API error: {e}")
+Example of CORRECT (branching) structure:
+  Decision 1
+  ├── Choice A → Situation A → Decision 2A → [branches to different endings]
+  ├── Choice B → Situation B → Decision 2B → [branches to different endings]
+  └── Choice C → Situation C → Decision 2C → [branches to different endings]
 
+## DESIGN PRINCIPLES
 
-def convert_ai_scenario_to_story(content: EducationalContent, scenario_data: dict) -> TwineStory:
-    """Convert AI-generated branching scenario data into a TwineStory object.
+### 1. MEANINGFUL BRANCHING
+- Each choice should lead to a narratively DIFFERENT situation
+- If you choose to confront someone vs. avoid them, the next scene should be COMPLETELY DIFFERENT
+- Choices have CONSEQUENCES that shape the rest of the story
+- Students should feel their choices MATTER
 
-    Handles the new branching tree structure where each choice leads to
-    genuinely different paths and outcomes.
+### 2. ALL CHOICES MUST SOUND REASONABLE
+- Every choice should sound like something a thoughtful professional might consider
+- Wrong choices reflect common misconceptions, not obvious mistakes
+- A student who hasn't studied should find all options equally plausible
+- NO choices like "ignore the problem" or "do nothing"
+
+### 3. CONSEQUENCES SNOWBALL
+- Early optimal choices → easier subsequent situations → better endings
+- Early poor choices → harder subsequent situations → worse endings
+- But EVERY path should be interesting and educational
+
+### 4. MULTIPLE ENDINGS
+- Each concept should have {branches_per_node} to {branches_per_node * 2} possible endings
+- Endings vary from "excellent application" (full points) to "needs review" (minimal points)
+- Each ending should explain what the student's path demonstrated
+
+## Theme: {theme}
+- Setting: {theme_context['setting']}
+- Student Role: {theme_context['role']}
+- Stakes: {theme_context['stakes']}
+"""
+
+    tail = f"""
+The supplementary materials, learning objectives, and key concepts to assess are provided above.
+
+## BRANCHING STRUCTURE REQUIREMENTS
+
+Create {concept_count} chapters, one per concept. Each chapter is a BRANCHING TREE:
+- Depth: {branching_depth} levels of decisions
+- Branches: {branches_per_node} choices at each decision point
+- Each branch leads to a UNIQUE next situation
+- Multiple endings per chapter (ranging from optimal to poor outcomes)
+
+## JSON OUTPUT FORMAT - BRANCHING TREE STRUCTURE
+
+"""
+
+    requirements = f"""
+## CRITICAL REQUIREMENTS
+
+1. Each node_id must be UNIQUE within the chapter
+2. Every "leads_to" must reference an existing node_id
+3. Decision nodes have "choices" array; ending nodes have "is_ending": true
+4. Situations in different branches must be NARRATIVELY DIFFERENT
+5. All choice text must be professional-sounding (max 60 chars)
+6. Endings should range from 100% (excellent) to 0% (needs review)
+7. Create {branches_per_node * 2} to {branches_per_node * 3} unique endings per concept
+8. The tree must have {branching_depth} levels of decisions before reaching endings
+
+Return ONLY valid JSON."""
+
+    return head, ''.join([tail, _BRANCHING_SCHEMA, requirements])
+
+
+def _build_scenario_prompt(content: EducationalContent,
+                           decision_nodes: int = 4, branches_per_node: int = 3,
+                           case_study_mode: bool = False, case_study: dict = None,
+                           custom_scenario_description: str = None) -> str:
+    """Build the per-call Claude prompt for a branching scenario."""
+    # Prepare custom scenario description if provided
+    custom_scenario_section = ""
+    if custom_scenario_description:
+        custom_scenario_section = f"""
+## CUSTOM SCENARIO DESCRIPTION (PRIMARY SOURCE - BUILD SCENARIO AROUND THIS)
+
+{custom_scenario_description}
+
+CRITICAL: The scenario MUST be built around this custom description. Use the specific:
+- Setting, location, and environment described
+- Characters, roles, and relationships mentioned
+- Situation, context, and circumstances outlined
+- Any specific details the instructor provided
+The student should experience EXACTLY the scenario described above. Do NOT substitute generic elements.
+"""
+
+    # Prepare case study content if provided
+    case_study_section = ""
+    if case_study_mode and case_study:
+        case_study_content = _truncate_to_tokens(case_study.get('content', ''), CASE_STUDY_TOKEN_BUDGET,
+                                                 "\n\n[Truncated...]")
+        case_study_section = f"""
+## CASE STUDY (PRIMARY SOURCE - BUILD SCENARIO AROUND THIS)
+Title: {case_study.get('title', 'Case Study')}
+
+{case_study_content}
+
+CRITICAL: The scenario MUST be built around this case study. Use its specific:
+- Characters, names, and roles
+- Situations and events described
+- Organizations and context
+- Actual dilemmas and decisions faced
+The student should feel they are living INSIDE this case, making the real decisions.
+"""
+
+    head, tail = _build_base_prompt(
+        content.theme, len(content.key_concepts), decision_nodes, branches_per_node
+    )
+    prompt = ''.join([head, custom_scenario_section, case_study_section, tail])
+
+    # Guarded so nothing is formatted or sliced unless DEBUG logging is on
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Custom scenario section present: %s", bool(custom_scenario_section))
+        logger.debug("Case study section present: %s", bool(case_study_section))
+        if custom_scenario_section:
+            logger.debug("Custom scenario section preview:\n%s", custom_scenario_section[:500])
+
+    return prompt
+
+
+class _JsonObjectScanner:
+    """
+    Incremental brace matcher for the first {...} object in a text stream.
+    Feed chunks in order; feed() returns True once the object has closed, after
+    which start/end give its offsets in the concatenated text. Braces inside JSON
+    strings are ignored.
     """
 
-    grading_config = GradingConfig(
-        enabled=True,
-        concept_points={c.name: c.points for c in content.key_concepts},
-        passing_threshold=content.passing_threshold,
-        total_points=content.total_points,
-        passing_points=content.passing_points
+    def __init__(self):
+        self.start = -1
+        self.end = -1
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._offset = 0
+
+    def feed(self, chunk: str) -> bool:
+        if self.end != -1:
+            return True
+
+        i = 0
+        if self.start == -1:
+            i = chunk.find('{')
+            if i == -1:
+                self._offset += len(chunk)
+                return False
+            self.start = self._offset + i
+
+        depth, in_string, escape = self._depth, self._in_string, self._escape
+        for i in range(i, len(chunk)):
+            ch = chunk[i]
+            if in_string:
+                if escape:
+                    escape = False
+                elif ch == '\\':
+                    escape = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch == '{':
+                depth += 1
+            elif ch == '}':
+                depth -= 1
+                if depth == 0:
+                    self.end = self._offset + i + 1
+                    return True
+
+        self._depth, self._in_string, self._escape = depth, in_string, escape
+        self._offset += len(chunk)
+        return False
+
+
+def _extract_json_object(text: str) -> Optional[str]:
+    """Return the first balanced {...} object in text, or None if there isn't one."""
+    scanner = _JsonObjectScanner()
+    if scanner.feed(text):
+        return text[scanner.start:scanner.end]
+    return None
+
+
+def _parse_scenario_response(response_text: str) -> dict:
+    """Extract the scenario JSON object from Claude's response text."""
+    json_text = _extract_json_object(response_text)
+    if json_text is None:
+        raise ValueError("No valid JSON found in AI response")
+    try:
+        return _json_loads(json_text)
+    except json.JSONDecodeError as e:  # orjson.JSONDecodeError subclasses this
+        raise ValueError(f"Failed to parse AI response as JSON: {e}")
+
+
+@functools.lru_cache(maxsize=4)
+def _get_anthropic_client(api_key: str) -> 'anthropic.Anthropic':
+    """Shared client per API key, so its HTTP connection pool is reused across calls."""
+    return anthropic.Anthropic(api_key=api_key)
+
+
+def _scenario_cache_path(request: dict) -> Optional[Path]:
+    """Cache file for a scenario request, or None when caching is off.
+
+    Caching is opt-in: set EDQUEST_CACHE_DIR (e.g. .edquest_cache) for offline or
+    batch builds where re-running the same inputs should reuse a paid-for reply.
+    Claude samples each reply, so with the cache on the same inputs always get the
+    same scenario back. Entries are shared across API keys, and the directory has
+    no size limit or eviction; clear it by hand.
+    """
+    cache_dir = os.environ.get('EDQUEST_CACHE_DIR')
+    if not cache_dir:
+        return None
+    key_source = json.dumps([CLAUDE_MODEL, CLAUDE_MAX_TOKENS, request], sort_keys=True)
+    cache_key = hashlib.blake2b(key_source.encode(), digest_size=16).hexdigest()
+    return Path(cache_dir) / f"{cache_key}.json"
+
+
+def _load_cached_scenario(cache_path: Optional[Path]) -> Optional[dict]:
+    """Return previously generated scenario data for this request, if any."""
+    if cache_path is None:
+        return None
+    try:
+        with open(cache_path, 'rb') as f:
+            return _json_loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _store_cached_scenario(cache_path: Optional[Path], scenario_data: dict) -> None:
+    """Save scenario data; a read-only filesystem only costs the cache, not the generation."""
+    if cache_path is None:
+        return
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump(scenario_data, f)
+    except OSError as e:
+        logger.warning("Could not write scenario cache: %s", e)
+
+
+def _discard_cached_scenario(content: EducationalContent, **options) -> None:
+    """Drop the cached scenario for these inputs, e.g. when it did not convert to a story."""
+    cache_path = _scenario_cache_path(_build_scenario_request(content, **options))
+    if cache_path is None:
+        return
+    try:
+        cache_path.unlink(missing_ok=True)
+    except OSError as e:
+        logger.warning("Could not remove scenario cache entry: %s", e)
+
+
+def generate_scenario_with_ai(content: EducationalContent, api_key: str,
+                               decision_nodes: int = 4, branches_per_node: int = 3,
+                               case_study_mode: bool = False, case_study: dict = None,
+                               custom_scenario_description: str = None) -> dict:
+    """
+    Use Claude AI to generate an application-focused educational scenario
+    with concise text and non-obvious choices that require critical thinking.
+    """
+    if not ANTHROPIC_AVAILABLE:
+        raise RuntimeError("anthropic package not installed. Run: pip install anthropic")
+
+    request = _build_scenario_request(
+        content,
+        decision_nodes=decision_nodes,
+        branches_per_node=branches_per_node,
+        case_study_mode=case_study_mode,
+        case_study=case_study,
+        custom_scenario_description=custom_scenario_description
     )
 
-    story = TwineStory(title=f"EdQuest: {content.theme}", grading=grading_config)
+    # With EDQUEST_CACHE_DIR set, identical inputs reuse the stored reply
+    cache_path = _scenario_cache_path(request)
+    scenario_data = _load_cached_scenario(cache_path)
+    if scenario_data is not None:
+        return scenario_data
 
-    # Introduction - immersive opening
-    intro = scenario_data.get('introduction', {})
-    concepts_text = "\n".join(f"- {c.name} ({c.points} pts)" for c in content.key_concepts)
+    client = _get_anthropic_client(api_key)
+    scanner = _JsonObjectScanner()
+    parts = []
+    try:
+        with client.messages.stream(
+            model=CLAUDE_MODEL,
+            max_tokens=CLAUDE_MAX_TOKENS,
+            **request
+        ) as stream:
+            for text in stream.text_stream:
+                parts.append(text)
+                # Stop once the JSON object closes; anything after it would be discarded
+                if scanner.feed(text):
+                    break
+    except anthropic.APIError as e:
+        raise RuntimeError(f"Claude API error: {e}")
+
+    scenario_data = _parse_scenario_response(''.join(parts))
+    _store_cached_scenario(cache_path, scenario_data)
+    return scenario_data
+
+
+async def generate_scenario_with_ai_async(content: EducationalContent, client,
+                                          semaphore: asyncio.Semaphore = None,
+                                          **options) -> dict:
+    """
+    Async variant of generate_scenario_with_ai using a shared AsyncAnthropic client.
+    The optional semaphore bounds how many requests are in flight at once.
+    """
+    request = _build_scenario_request(content, **options)
+    cache_path = _scenario_cache_path(request)
+    scenario_data = _load_cached_scenario(cache_path)
+    if scenario_data is not None:
+        return scenario_data
+
+    semaphore = semaphore or asyncio.Semaphore(1)
+    scanner = _JsonObjectScanner()
+    parts = []
+    try:
+        async with semaphore:
+            async with client.messages.stream(
+                model=CLAUDE_MODEL,
+                max_tokens=CLAUDE_MAX_TOKENS,
+                **request
+            ) as stream:
+                async for text in stream.text_stream:
+                    parts.append(text)
+                    if scanner.feed(text):
+                        break
+    except anthropic.APIError as e:
+        raise RuntimeError(f"Claude API error: {e}")
+
+    scenario_data = _parse_scenario_response(''.join(parts))
+    _store_cached_scenario(cache_path, scenario_data)
+    return scenario_data
 
-    # Use opening_narrative if available, fall back to situation for backwards compatibility
-    opening_text = intro.get('opening_narrative', intro.get('situation', 'You are about to face a branching narrative.'))
 
-    intro_content = f"""<div class="chapter-header">
-<h2>{content.theme}</h2>
+# Opening passage of AI-generated scenarios; parsed once, filled with format_map per story
+_AI_INTRO_TMPL = """<div class="chapter-header">
+<h2>{theme}</h2>
 </div>
 
 {opening_text}
 
 <div class="scenario-context">
-**Your Role:** {intro.get('role', 'Decision-maker in this scenario')}
+**Your Role:** {role}
 
-**Stakes:** {intro.get('stakes', 'Your choices will be evaluated.')}
+**Stakes:** {stakes}
 </div>
 
 <div class="scenario-context">
 **Concepts assessed:**
 {concepts_text}
 
-**Total Points:** {content.total_points} | **Passing:** {content.passing_threshold}%
+**Total Points:** {total_points} | **Passing:** {passing_threshold}%
 </div>"""
 
-    story.add_passage(Passage(
-        name="Start",
-        content=intro_content,
-        choices=[Choice("Begin", "Chapter 1")],
-        position_y=100
-    ))
-
-    # Generate passages for each chapter (concept) using BRANCHING TREE structure
-    chapters = scenario_data.get('chapters', [])
-    y_pos = 250
-
-    for chapter_idx, chapter in enumerate(chapters):
-        concept_num = chapter_idx + 1
-        concept_name = chapter.get('concept', f'Concept {concept_num}')
-        chapter_title = chapter.get('title', concept_name)
+_AI_RESULTS_TMPL = """<div class="chapter-header">
+<h2>Results</h2>
+</div>
 
-        # Find points for this concept
-        points = content.default_points
-        for c in content.key_concepts:
-            if c.name.lower() == concept_name.lower():
-                points = c.points
-                break
+{{RESULTS_BOX}}
 
-        is_final_chapter = (chapter_idx == len(chapters) - 1)
-        next_chapter = f"Chapter {concept_num + 1}" if not is_final_chapter else "Results"
+{high_score}"""
 
-        # Chapter setup - brief
-        setup_text = chapter.get('setup', 'A new situation requires your decision.')
-        setup_content = f"""<div class="chapter-header">
+# Per-chapter passages of AI-generated scenarios
+_AI_CHAPTER_TMPL = """<div class="chapter-header">
 <span class="chapter-num">Chapter {concept_num}: {concept_name}</span>
 <h2>{chapter_title}</h2>
 </div>
 
 {setup_text}"""
 
-        story.add_passage(Passage(
-            name=f"Chapter {concept_num}",
-            content=setup_content,
-            choices=[Choice("Continue", f"C{concept_num}_root")],
-            position_y=y_pos
-        ))
-        y_pos += 120
+_AI_DECISION_TMPL = """{situation}
 
-        # Check if this chapter uses the new branching tree structure
-        branch_tree = chapter.get('branch_tree', None)
+<div class="decision-prompt">{prompt}</div>"""
 
-        if branch_tree:
-            # NEW BRANCHING TREE STRUCTURE
-            # Process each node in the branch tree
-            for node_id, node in branch_tree.items():
-                passage_name = f"C{concept_num}_{node_id}"
-
-                if node.get('is_ending', False):
-                    # This is an ending node - award points based on score_percent
-                    score_percent = node.get('score_percent', 0)
-                    earned_points = int(points * score_percent / 100)
-                    title = node.get('title', 'Outcome')
-                    narrative = node.get('narrative', 'The scenario concludes.')
-                    feedback = node.get('feedback', '')
-                    concept_demo = node.get('concept_demonstrated', '')
-
-                    # Determine feedback style based on score
-                    if score_percent >= 80:
-                        feedback_class = "feedback-correct"
-                        points_class = "points-earned"
-                        status = "Excellent!"
-                    elif score_percent >= 50:
-                        feedback_class = "feedback-partial"
-                        points_class = "points-partial"
-                        status = "Good effort."
-                    else:
-                        feedback_class = "feedback-incorrect"
-                        points_class = "points-missed"
-                        status = "Needs review."
+_AI_FEEDBACK_TMPL = """<div class="{feedback_class}">{text}</div>"""
 
-                    ending_content = f"""<div class="chapter-header">
+_AI_ENDING_TMPL = """<div class="chapter-header">
 <h2>{title}</h2>
 </div>
 
@@ -1521,87 +1725,237 @@ def convert_ai_scenario_to_story(content: EducationalContent, scenario_data: dic
 <div class="source-reference"><strong>Assessment:</strong> {feedback}</div>
 <div class="source-reference"><strong>Concept Application:</strong> {concept_demo}</div>"""
 
-                    # Determine tags based on score for grading system
-                    if score_percent >= 80:
-                        tags = ["correct", f"concept-{concept_num}", f"score-{score_percent}"]
-                    elif score_percent >= 50:
-                        tags = ["partial", f"concept-{concept_num}", f"score-{score_percent}"]
-                    else:
-                        tags = ["incorrect", f"concept-{concept_num}", f"score-{score_percent}"]
+_AI_BEST_TMPL = """<div class="feedback-correct">
+<strong>Well done!</strong> <span class="points-earned">+{points} points</span>
+</div>
 
-                    story.add_passage(Passage(
-                        name=passage_name,
-                        content=ending_content,
-                        choices=[Choice("Continue", next_chapter)],
-                        tags=tags,
-                        position_y=y_pos
-                    ))
-                    y_pos += 120
+{consequence}
 
-                else:
-                    # This is a decision node - create choices that branch
-                    situation = node.get('situation', 'You face a decision.')
-                    choices_data = node.get('choices', [])
-
-                    decision_content = f"""{situation}
-
-<div class="decision-prompt">What do you do?</div>"""
-
-                    # Build passage choices - shuffle to randomize position
-                    passage_choices = []
-                    choices_list = list(choices_data)
-                    random.shuffle(choices_list)
-
-                    for choice in choices_list:
-                        choice_text = choice.get('text', 'Take action')[:60]
-                        leads_to = choice.get('leads_to', 'root')
-                        target = f"C{concept_num}_{leads_to}"
-                        transition = choice.get('transition', '')
-
-                        # Store transition text for display after choice
-                        passage_choices.append(Choice(choice_text, f"{target}_trans" if transition else target))
-
-                        # Create transition passage if there's transition text
-                        if transition:
-                            quality = choice.get('quality', 'adequate')
-                            if quality == 'optimal':
-                                trans_class = "feedback-correct"
-                            elif quality == 'adequate':
-                                trans_class = "feedback-partial"
-                            else:
-                                trans_class = "feedback-incorrect"
-
-                            story.add_passage(Passage(
-                                name=f"{target}_trans",
-                                content=f"""<div class="{trans_class}">{transition}</div>""",
-                                choices=[Choice("Continue", target)],
-                                position_y=y_pos
-                            ))
-                            y_pos += 60
-
-                    story.add_passage(Passage(
-                        name=passage_name,
-                        content=decision_content,
-                        choices=passage_choices,
-                        position_y=y_pos
-                    ))
-                    y_pos += 100
+<div class="source-reference"><strong>Why this works:</strong> {feedback}</div>
+
+{resolution}"""
+
+_AI_PARTIAL_TMPL = """<div class="feedback-partial">
+<strong>Partially correct.</strong> <span class="points-partial">+{points} points</span>
+</div>
+
+{consequence}
+
+<div class="source-reference"><strong>What was missing:</strong> {feedback}</div>
+{better_ref}
+
+{resolution}"""
+
+_AI_POOR_TMPL = """<div class="feedback-incorrect">
+<strong>Not quite right.</strong> <span class="points-missed">0 points</span>
+</div>
+
+{consequence}
+
+<div class="source-reference"><strong>Issue:</strong> {feedback}</div>
+{better_ref}
+
+{resolution}"""
+
+_AI_BETTER_REF_TMPL = """<div class="source-reference"><strong>Better approach:</strong> {better}</div>"""
+
+# Ending styles by minimum score: (threshold, feedback class, points class, status, tag)
+_SCORE_BUCKETS = (
+    (80, "feedback-correct", "points-earned", "Excellent!", "correct"),
+    (50, "feedback-partial", "points-partial", "Good effort.", "partial"),
+    (0, "feedback-incorrect", "points-missed", "Needs review.", "incorrect"),
+)
+
+# Transition styling by branch-tree choice quality; anything else reads as a poor choice
+_QUALITY_CLASS = {"optimal": "feedback-correct", "adequate": "feedback-partial"}
+_DEFAULT_QUALITY_CLASS = "feedback-incorrect"
+
+# Linear-decision choice quality, including the older best/partial labels
+_BEST_RANK, _PARTIAL_RANK, _POOR_RANK = 0, 1, 2
+_QUALITY_RANK = {"best": _BEST_RANK, "optimal": _BEST_RANK, "partial": _PARTIAL_RANK, "adequate": _PARTIAL_RANK}
+
+
+def _emit_branch_tree(branch_tree: dict, concept_num: int, concept_tag: str, points: int,
+                      next_chapter: str, new_passages: list[Passage]) -> None:
+    """Append the passages for one chapter's branch tree to new_passages."""
+    for node_id, node in branch_tree.items():
+        passage_name = f"C{concept_num}_{node_id}"
+        g = node.get
+
+        if g('is_ending'):
+            # This is an ending node - award points based on score_percent
+            score_percent = g('score_percent', 0)
+            earned_points = int(points * score_percent) // 100
+            title = g('title', 'Outcome')
+            narrative = g('narrative', 'The scenario concludes.')
+            feedback = g('feedback', '')
+            concept_demo = g('concept_demonstrated', '')
+
+            # Determine feedback style and grading tag based on score
+            for threshold, feedback_class, points_class, status, score_tag in _SCORE_BUCKETS:
+                if score_percent >= threshold:
+                    break
+
+            ending_content = _AI_ENDING_TMPL.format_map({
+                'title': title,
+                'feedback_class': feedback_class,
+                'status': status,
+                'points_class': points_class,
+                'earned_points': earned_points,
+                'score_percent': score_percent,
+                'narrative': narrative,
+                'feedback': feedback,
+                'concept_demo': concept_demo
+            })
+
+            tags = [score_tag, concept_tag, f"score-{score_percent}"]
+
+            new_passages.append(Passage(
+                name=passage_name,
+                content=ending_content,
+                choices=[Choice("Continue", next_chapter)],
+                tags=tags
+            ))
+
+        else:
+            # This is a decision node - create choices that branch
+            situation = g('situation', 'You face a decision.')
+            choices_data = g('choices', [])
+
+            decision_content = _AI_DECISION_TMPL.format_map({'situation': situation, 'prompt': 'What do you do?'})
+
+            # Build passage choices - shuffle to randomize position
+            choices_list = choices_data[:]
+            _shuffle(choices_list)
+            passage_choices = [None] * len(choices_list)
+
+            for idx, choice in enumerate(choices_list):
+                cg = choice.get
+                choice_text = cg('text', 'Take action')[:60]
+                leads_to = cg('leads_to', 'root')
+                target = f"C{concept_num}_{leads_to}"
+                transition = cg('transition')
+
+                if not transition:
+                    passage_choices[idx] = Choice(choice_text, target)
+                    continue
+
+                # Route through a transition passage that shows the choice's outcome
+                trans_name = f"{target}_trans"
+                passage_choices[idx] = Choice(choice_text, trans_name)
+
+                trans_class = _QUALITY_CLASS.get(cg('quality', 'adequate'), _DEFAULT_QUALITY_CLASS)
+
+                new_passages.append(Passage(
+                    name=trans_name,
+                    content=_AI_FEEDBACK_TMPL.format_map({'feedback_class': trans_class, 'text': transition}),
+                    choices=[Choice("Continue", target)]
+                ))
+
+            new_passages.append(Passage(
+                name=passage_name,
+                content=decision_content,
+                choices=passage_choices
+            ))
+
+
+def convert_ai_scenario_to_story(content: EducationalContent, scenario_data: dict) -> TwineStory:
+    """Convert AI-generated branching scenario data into a TwineStory object.
+
+    Handles the new branching tree structure where each choice leads to
+    genuinely different paths and outcomes.
+    """
+
+    grading_config = GradingConfig(
+        enabled=True,
+        concept_points={c.name: c.points for c in content.key_concepts},
+        passing_threshold=content.passing_threshold,
+        total_points=content.total_points,
+        passing_points=content.passing_points
+    )
+
+    story = TwineStory(title=f"EdQuest: {content.theme}", grading=grading_config)
+
+    # Introduction - immersive opening
+    intro = scenario_data.get('introduction', {})
+    concepts_text = "\n".join(["- %s (%s pts)" % (c.name, c.points) for c in content.key_concepts])
+
+    # Use opening_narrative if available, fall back to situation for backwards compatibility
+    opening_text = intro.get('opening_narrative', intro.get('situation', 'You are about to face a branching narrative.'))
+
+    intro_content = _AI_INTRO_TMPL.format_map({
+        'theme': content.theme,
+        'opening_text': opening_text,
+        'role': intro.get('role', 'Decision-maker in this scenario'),
+        'stakes': intro.get('stakes', 'Your choices will be evaluated.'),
+        'concepts_text': concepts_text,
+        'total_points': content.total_points,
+        'passing_threshold': content.passing_threshold
+    })
+
+    story.add_passage(Passage(
+        name="Start",
+        content=intro_content,
+        choices=[Choice("Begin", "Chapter 1")]
+    ))
+
+    # Generate passages for each chapter (concept) using BRANCHING TREE structure
+    chapters = scenario_data.get('chapters', [])
+
+    # Points per concept, matched case-insensitively (reversed so the first duplicate wins)
+    points_by_name = {c.name.lower(): c.points for c in reversed(content.key_concepts)}
+
+    # Where each chapter's endings lead; the last chapter goes to Results
+    next_names = [f"Chapter {k}" for k in range(2, len(chapters) + 1)] + ["Results"]
+
+    new_passages = []
+    for chapter_idx, chapter in enumerate(chapters):
+        concept_num = chapter_idx + 1
+        concept_name = chapter.get('concept', f'Concept {concept_num}')
+        chapter_title = chapter.get('title', concept_name)
+
+        points = points_by_name.get(concept_name.lower(), content.default_points)
+
+        next_chapter = next_names[chapter_idx]
+        concept_tag = sys.intern(f"concept-{concept_num}")
+
+        # Chapter setup - brief
+        setup_text = chapter.get('setup', 'A new situation requires your decision.')
+        setup_content = _AI_CHAPTER_TMPL.format_map({
+            'concept_num': concept_num,
+            'concept_name': concept_name,
+            'chapter_title': chapter_title,
+            'setup_text': setup_text
+        })
+
+        new_passages.append(Passage(
+            name=f"Chapter {concept_num}",
+            content=setup_content,
+            choices=[Choice("Continue", f"C{concept_num}_root")]
+        ))
+
+        # Check if this chapter uses the new branching tree structure
+        branch_tree = chapter.get('branch_tree')
+
+        if branch_tree:
+            # NEW BRANCHING TREE STRUCTURE
+            _emit_branch_tree(branch_tree, concept_num, concept_tag, points, next_chapter, new_passages)
 
         else:
             # FALLBACK: Old linear structure for backwards compatibility
             decisions = chapter.get('decisions', [])
             num_decisions = len(decisions)
+            fpfx = f"C{concept_num}"
 
             for dec_idx, decision in enumerate(decisions):
                 dec_num = dec_idx + 1
+                pfx = f"{fpfx}D{dec_num}"
                 is_final_decision = (dec_idx == num_decisions - 1)
 
                 situation = decision.get('situation', 'You must make a choice.')
                 prompt = decision.get('prompt', 'What do you do?')
 
-                decision_content = f"""{situation}
-
-<div class="decision-prompt">{prompt}</div>"""
+                decision_content = _AI_DECISION_TMPL.format_map({'situation': situation, 'prompt': prompt})
 
                 choices = decision.get('choices', [])
                 passage_choices = []
@@ -1611,10 +1965,10 @@ def convert_ai_scenario_to_story(content: EducationalContent, scenario_data: dic
                 poor_choices = []
 
                 for choice in choices:
-                    quality = choice.get('quality', 'poor')
-                    if quality in ['best', 'optimal']:
+                    rank = _QUALITY_RANK.get(choice.get('quality', 'poor'), _POOR_RANK)
+                    if rank == _BEST_RANK:
                         best_choice = choice
-                    elif quality in ['partial', 'adequate']:
+                    elif rank == _PARTIAL_RANK:
                         partial_choice = choice
                     else:
                         poor_choices.append(choice)
@@ -1632,156 +1986,131 @@ def convert_ai_scenario_to_story(content: EducationalContent, scenario_data: dic
                 for i, pc in enumerate(poor_choices):
                     all_choices.append((f'poor{i}', pc))
 
-                random.shuffle(all_choices)
+                _shuffle(all_choices)
 
                 for quality_key, choice in all_choices:
                     choice_text = choice.get('text', 'Take action')[:60]
 
                     if is_final_decision:
                         if quality_key == 'best':
-                            target = f"C{concept_num}Best"
+                            target = fpfx + "Best"
                         elif quality_key == 'partial':
-                            target = f"C{concept_num}Partial"
+                            target = fpfx + "Partial"
                         else:
-                            target = f"C{concept_num}Poor{quality_key[-1] if quality_key[-1].isdigit() else '0'}"
+                            target = fpfx + "Poor" + (quality_key[-1] if quality_key[-1].isdigit() else '0')
                     else:
                         if quality_key == 'best':
-                            target = f"C{concept_num}D{dec_num}Best"
+                            target = pfx + "Best"
                         elif quality_key == 'partial':
-                            target = f"C{concept_num}D{dec_num}Partial"
+                            target = pfx + "Partial"
                         else:
-                            target = f"C{concept_num}D{dec_num}Poor"
+                            target = pfx + "Poor"
 
                     passage_choices.append(Choice(choice_text, target))
 
                 # For backwards compatibility, use C{n}_root for first decision
-                passage_name = f"C{concept_num}_root" if dec_num == 1 else f"C{concept_num}D{dec_num}"
+                passage_name = fpfx + "_root" if dec_num == 1 else pfx
 
-                story.add_passage(Passage(
+                new_passages.append(Passage(
                     name=passage_name,
                     content=decision_content,
-                    choices=passage_choices,
-                    position_y=y_pos
+                    choices=passage_choices
                 ))
-                y_pos += 100
 
                 if not is_final_decision:
-                    next_decision = f"C{concept_num}D{dec_num + 1}"
+                    next_decision = f"{fpfx}D{dec_num + 1}"
 
                     if best_choice:
                         consequence = best_choice.get('consequence', 'Good outcome.')
-                        story.add_passage(Passage(
-                            name=f"C{concept_num}D{dec_num}Best",
-                            content=f"""<div class="feedback-correct">{consequence}</div>""",
-                            choices=[Choice("Continue", next_decision)],
-                            position_y=y_pos
+                        new_passages.append(Passage(
+                            name=pfx + "Best",
+                            content=_AI_FEEDBACK_TMPL.format_map({'feedback_class': "feedback-correct", 'text': consequence}),
+                            choices=[Choice("Continue", next_decision)]
                         ))
-                        y_pos += 80
 
                     if partial_choice:
                         consequence = partial_choice.get('consequence', 'Mixed results.')
-                        story.add_passage(Passage(
-                            name=f"C{concept_num}D{dec_num}Partial",
-                            content=f"""<div class="feedback-partial">{consequence}</div>""",
-                            choices=[Choice("Continue", next_decision)],
-                            position_y=y_pos
+                        new_passages.append(Passage(
+                            name=pfx + "Partial",
+                            content=_AI_FEEDBACK_TMPL.format_map({'feedback_class': "feedback-partial", 'text': consequence}),
+                            choices=[Choice("Continue", next_decision)]
                         ))
-                        y_pos += 80
 
                     if poor_choices:
                         consequence = poor_choices[0].get('consequence', 'This creates issues.')
-                        story.add_passage(Passage(
-                            name=f"C{concept_num}D{dec_num}Poor",
-                            content=f"""<div class="feedback-incorrect">{consequence}</div>""",
-                            choices=[Choice("Continue", next_decision)],
-                            position_y=y_pos
+                        new_passages.append(Passage(
+                            name=pfx + "Poor",
+                            content=_AI_FEEDBACK_TMPL.format_map({'feedback_class': "feedback-incorrect", 'text': consequence}),
+                            choices=[Choice("Continue", next_decision)]
                         ))
-                        y_pos += 80
 
                 else:
                     resolution = chapter.get('resolution', '')
 
+                    # Pointer to the best answer, shared by the partial and poor outcomes
+                    better = best_choice.get('feedback', '') if best_choice else ''
+                    better_ref = _AI_BETTER_REF_TMPL.format_map({'better': better[:150]}) if better else ''
+
                     if best_choice:
                         feedback = best_choice.get('feedback', 'Correct application of the concept.')
                         consequence = best_choice.get('consequence', 'Success.')
-                        story.add_passage(Passage(
-                            name=f"C{concept_num}Best",
-                            content=f"""<div class="feedback-correct">
-<strong>Well done!</strong> <span class="points-earned">+{points} points</span>
-</div>
-
-{consequence}
-
-<div class="source-reference"><strong>Why this works:</strong> {feedback}</div>
-
-{resolution}""",
+                        new_passages.append(Passage(
+                            name=fpfx + "Best",
+                            content=_AI_BEST_TMPL.format_map({
+                                'points': points,
+                                'consequence': consequence,
+                                'feedback': feedback,
+                                'resolution': resolution
+                            }),
                             choices=[Choice("Continue", next_chapter)],
-                            tags=["correct", f"concept-{concept_num}"],
-                            position_y=y_pos
+                            tags=["correct", concept_tag]
                         ))
-                        y_pos += 120
 
                     if partial_choice:
                         partial_pts = points // 2
                         feedback = partial_choice.get('feedback', 'Partially correct.')
                         consequence = partial_choice.get('consequence', 'Mixed results.')
-                        better = best_choice.get('feedback', '') if best_choice else ''
-                        story.add_passage(Passage(
-                            name=f"C{concept_num}Partial",
-                            content=f"""<div class="feedback-partial">
-<strong>Partially correct.</strong> <span class="points-partial">+{partial_pts} points</span>
-</div>
-
-{consequence}
-
-<div class="source-reference"><strong>What was missing:</strong> {feedback}</div>
-{f'<div class="source-reference"><strong>Better approach:</strong> {better[:150]}</div>' if better else ''}
-
-{resolution}""",
+                        new_passages.append(Passage(
+                            name=fpfx + "Partial",
+                            content=_AI_PARTIAL_TMPL.format_map({
+                                'points': partial_pts,
+                                'consequence': consequence,
+                                'feedback': feedback,
+                                'better_ref': better_ref,
+                                'resolution': resolution
+                            }),
                             choices=[Choice("Continue", next_chapter)],
-                            tags=["partial", f"concept-{concept_num}"],
-                            position_y=y_pos
+                            tags=["partial", concept_tag]
                         ))
-                        y_pos += 120
 
-                    for i, poor in enumerate(poor_choices[:2]):
+                    for i, poor in enumerate(islice(poor_choices, 2)):
                         feedback = poor.get('feedback', 'This approach has issues.')
                         consequence = poor.get('consequence', 'Problems occurred.')
-                        better = best_choice.get('feedback', '') if best_choice else ''
-                        story.add_passage(Passage(
-                            name=f"C{concept_num}Poor{i}",
-                            content=f"""<div class="feedback-incorrect">
-<strong>Not quite right.</strong> <span class="points-missed">0 points</span>
-</div>
-
-{consequence}
-
-<div class="source-reference"><strong>Issue:</strong> {feedback}</div>
-{f'<div class="source-reference"><strong>Better approach:</strong> {better[:150]}</div>' if better else ''}
-
-{resolution}""",
+                        new_passages.append(Passage(
+                            name=f"{fpfx}Poor{i}",
+                            content=_AI_POOR_TMPL.format_map({
+                                'consequence': consequence,
+                                'feedback': feedback,
+                                'better_ref': better_ref,
+                                'resolution': resolution
+                            }),
                             choices=[Choice("Continue", next_chapter)],
-                            tags=["incorrect", f"concept-{concept_num}"],
-                            position_y=y_pos
+                            tags=["incorrect", concept_tag]
                         ))
-                        y_pos += 120
+
+    story.extend_passages(new_passages)
 
     # Results passage
     conclusion = scenario_data.get('conclusion', {})
-    results_content = f"""<div class="chapter-header">
-<h2>Results</h2>
-</div>
-
-{{RESULTS_BOX}}
-
-{conclusion.get('high_score', 'Great job applying these concepts!')}"""
+    results_content = _AI_RESULTS_TMPL.format_map({
+        'high_score': conclusion.get('high_score', 'Great job applying these concepts!')
+    })
 
     story.add_passage(Passage(
         name="Results",
         content=results_content,
         choices=[Choice("Try Again", "Start")],
-        tags=["ending", "results"],
-        position_y=y_pos
+        tags=["ending", "results"]
     ))
 
     return story
@@ -1795,64 +2124,158 @@ def generate_educational_scenario(content: EducationalContent, api_key: str = No
     Generate an educational scenario, using AI if available.
     Falls back to template-based generation if AI is not available or fails.
     """
-    print(f"[EdQuest] generate_educational_scenario called")
-    print(f"[EdQuest] api_key provided: {bool(api_key)}, length: {len(api_key) if api_key else 0}")
-    print(f"[EdQuest] ANTHROPIC_AVAILABLE: {ANTHROPIC_AVAILABLE}")
+    logger.debug("generate_educational_scenario called (api_key provided: %s, ANTHROPIC_AVAILABLE: %s)",
+                 bool(api_key), ANTHROPIC_AVAILABLE)
 
     if api_key and ANTHROPIC_AVAILABLE:
-        print("[EdQuest] Attempting AI generation...")
+        logger.debug("Attempting AI generation")
+        options = dict(
+            decision_nodes=decision_nodes,
+            branches_per_node=branches_per_node,
+            case_study_mode=case_study_mode,
+            case_study=case_study,
+            custom_scenario_description=custom_scenario_description
+        )
         try:
-            scenario_data = generate_scenario_with_ai(
-                content, api_key,
-                decision_nodes=decision_nodes,
-                branches_per_node=branches_per_node,
-                case_study_mode=case_study_mode,
-                case_study=case_study,
-                custom_scenario_description=custom_scenario_description
-            )
-            print("[EdQuest] AI generation successful!")
-            return convert_ai_scenario_to_story(content, scenario_data)
+            scenario_data = generate_scenario_with_ai(content, api_key, **options)
+            logger.debug("AI generation successful")
+            try:
+                return convert_ai_scenario_to_story(content, scenario_data)
+            except Exception:
+                # A reply that parsed but can't be converted must not be served from the cache on retry
+                _discard_cached_scenario(content, **options)
+                raise
         except Exception as e:
-            import traceback
-            print(f"[EdQuest] AI generation failed: {type(e).__name__}: {e}")
-            traceback.print_exc()
-            print("[EdQuest] Falling back to template...")
+            logger.warning("AI generation failed, falling back to template: %s: %s", type(e).__name__, e)
+            logger.debug("AI generation traceback", exc_info=True)
     else:
-        print(f"[EdQuest] Skipping AI - api_key: {bool(api_key)}, ANTHROPIC_AVAILABLE: {ANTHROPIC_AVAILABLE}")
+        logger.debug("Skipping AI generation (api_key provided: %s, ANTHROPIC_AVAILABLE: %s)",
+                     bool(api_key), ANTHROPIC_AVAILABLE)
 
     return generate_template_scenario(content, decision_nodes, branches_per_node)
 
 
-def generate_template_scenario(content: EducationalContent,
-                                decision_nodes: int = 4, branches_per_node: int = 3) -> TwineStory:
+async def generate_educational_scenarios_async(contents: list[EducationalContent], api_key: str,
+                                               decision_nodes: int = 4, branches_per_node: int = 3,
+                                               max_concurrency: int = 10) -> list[TwineStory]:
     """
-    Generate a template-based educational scenario (fallback when AI unavailable).
+    Generate one scenario per content concurrently with AsyncAnthropic.
+    Requests run in parallel (at most max_concurrency at a time to stay under
+    rate limits); any scenario whose AI generation fails falls back to the template.
     """
-    grading_config = GradingConfig(
-        enabled=True,
-        concept_points={c.name: c.points for c in content.key_concepts},
-        passing_threshold=content.passing_threshold,
-        total_points=content.total_points,
-        passing_points=content.passing_points
-    )
+    if not ANTHROPIC_AVAILABLE:
+        raise RuntimeError("anthropic package not installed. Run: pip install anthropic")
 
-    story = TwineStory(title=f"EdQuest: {content.theme}", grading=grading_config)
-    theme_context = get_theme_context(content.theme)
+    client = anthropic.AsyncAnthropic(api_key=api_key)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    results = await asyncio.gather(*[
+        generate_scenario_with_ai_async(
+            content, client, semaphore,
+            decision_nodes=decision_nodes,
+            branches_per_node=branches_per_node
+        )
+        for content in contents
+    ], return_exceptions=True)
+
+    stories = []
+    for content, scenario_data in zip(contents, results):
+        if not isinstance(scenario_data, Exception):
+            try:
+                stories.append(convert_ai_scenario_to_story(content, scenario_data))
+                continue
+            except Exception as e:
+                _discard_cached_scenario(content, decision_nodes=decision_nodes,
+                                         branches_per_node=branches_per_node)
+                scenario_data = e
+        logger.warning("AI generation failed for '%s', falling back to template: %s: %s",
+                       content.theme, type(scenario_data).__name__, scenario_data)
+        stories.append(generate_template_scenario(content, decision_nodes, branches_per_node))
+    return stories
+
+
+def generate_educational_scenarios(contents: list[EducationalContent], api_key: str,
+                                   decision_nodes: int = 4, branches_per_node: int = 3,
+                                   max_concurrency: int = 10) -> list[TwineStory]:
+    """Synchronous wrapper around generate_educational_scenarios_async."""
+    return asyncio.run(generate_educational_scenarios_async(
+        contents, api_key,
+        decision_nodes=decision_nodes,
+        branches_per_node=branches_per_node,
+        max_concurrency=max_concurrency
+    ))
 
-    # Build introduction
-    objectives_text = "\n".join(f"- {obj}" for obj in content.learning_objectives)
-    concepts_text = "\n".join(f"- {c.name} ({c.points} pts)" for c in content.key_concepts)
 
-    intro_content = f"""<div class="chapter-header">
+def generate_educational_scenarios_batch(contents: list[EducationalContent], api_key: str,
+                                         decision_nodes: int = 4, branches_per_node: int = 3,
+                                         poll_interval: float = 30) -> list[TwineStory]:
+    """
+    Generate one scenario per content through the Anthropic Message Batches API.
+    Batches cost half as much as interactive calls but may take minutes to hours,
+    so this is meant for offline builds. Scenarios whose request fails fall back
+    to the template.
+    """
+    if not ANTHROPIC_AVAILABLE:
+        raise RuntimeError("anthropic package not installed. Run: pip install anthropic")
+
+    client = _get_anthropic_client(api_key)
+    batch = client.messages.batches.create(requests=[
+        {
+            "custom_id": f"scenario-{i}",
+            "params": {
+                "model": CLAUDE_MODEL,
+                "max_tokens": CLAUDE_MAX_TOKENS,
+                **_build_scenario_request(
+                    content,
+                    decision_nodes=decision_nodes,
+                    branches_per_node=branches_per_node
+                )
+            }
+        }
+        for i, content in enumerate(contents)
+    ])
+    print(f"[EdQuest] Submitted batch {batch.id} with {len(contents)} scenario(s)")
+
+    while batch.processing_status != "ended":
+        time.sleep(poll_interval)
+        batch = client.messages.batches.retrieve(batch.id)
+
+    # Results are not guaranteed to come back in submission order
+    scenario_data_by_id = {}
+    for entry in client.messages.batches.results(batch.id):
+        if entry.result.type != "succeeded":
+            print(f"[EdQuest] Batch request {entry.custom_id} {entry.result.type}")
+            continue
+        try:
+            scenario_data_by_id[entry.custom_id] = _parse_scenario_response(
+                entry.result.message.content[0].text
+            )
+        except ValueError as e:
+            print(f"[EdQuest] Batch request {entry.custom_id} returned unusable JSON: {e}")
+
+    stories = []
+    for i, content in enumerate(contents):
+        scenario_data = scenario_data_by_id.get(f"scenario-{i}")
+        if scenario_data is not None:
+            try:
+                stories.append(convert_ai_scenario_to_story(content, scenario_data))
+                continue
+            except Exception as e:
+                print(f"[EdQuest] Batch request scenario-{i} could not be converted: "
+                      f"{type(e).__name__}: {e}")
+        stories.append(generate_template_scenario(content, decision_nodes, branches_per_node))
+    return stories
+
+
+_TEMPLATE_INTRO_TMPL = """<div class="chapter-header">
 <span class="chapter-num">Welcome</span>
-<h2>{content.theme}</h2>
+<h2>{theme}</h2>
 </div>
 
 <div class="theme-atmosphere">
-{theme_context['atmosphere']}
+{atmosphere}
 </div>
 
-You find yourself {theme_context['setting']}. As {theme_context['role']}, you must navigate complex situations that will test your knowledge and decision-making abilities.
+You find yourself {setting}. As {role}, you must navigate complex situations that will test your knowledge and decision-making abilities.
 
 **Learning Objectives:**
 {objectives_text}
@@ -1860,39 +2283,19 @@ You find yourself {theme_context['setting']}. As {theme_context['role']}, you mu
 **You will be assessed on:**
 {concepts_text}
 
-**Total Points:** {content.total_points} | **Passing Score:** {content.passing_threshold}%
+**Total Points:** {total_points} | **Passing Score:** {passing_threshold}%
 
 <div class="source-reference">
 <strong>Important:</strong> The correct answers require understanding and applying what you learned from the source materials.
 </div>"""
 
-    story.add_passage(Passage(
-        name="Start",
-        content=intro_content,
-        choices=[Choice("Begin the scenario", "Scenario 1")],
-        position_y=100
-    ))
-
-    # Generate scenario for each concept
-    y_pos = 250
-    num_concepts = len(content.key_concepts)
-
-    for i, concept_obj in enumerate(content.key_concepts):
-        concept = concept_obj.name
-        points = concept_obj.points
-        scenario_num = i + 1
-        is_final = (i == num_concepts - 1)
-        next_scenario = f"Scenario {scenario_num + 1}" if not is_final else "Results"
-
-        npc = theme_context['npcs'][i % len(theme_context['npcs'])]
-
-        scenario_content = f"""<div class="chapter-header">
+_TEMPLATE_SCENARIO_TMPL = """<div class="chapter-header">
 <span class="chapter-num">Chapter {scenario_num}</span>
 <h2>{concept}</h2>
 </div>
 
 <div class="theme-atmosphere">
-{theme_context['atmosphere']}
+{atmosphere}
 </div>
 
 <div class="scenario-context">
@@ -1907,19 +2310,7 @@ You encounter a situation that requires your understanding of **{concept}**. The
 What is the best course of action?
 </div>"""
 
-        story.add_passage(Passage(
-            name=f"Scenario {scenario_num}",
-            content=scenario_content,
-            choices=[
-                Choice(f"Apply established {concept} principles", f"Correct {scenario_num}"),
-                Choice("Take a simplified approach", f"Incorrect {scenario_num}a"),
-                Choice("Defer the decision", f"Incorrect {scenario_num}b"),
-            ],
-            position_y=y_pos
-        ))
-        y_pos += 150
-
-        correct_content = f"""<div class="feedback-correct">
+_TEMPLATE_CORRECT_TMPL = """<div class="feedback-correct">
 <strong>Excellent choice!</strong> <span class="points-earned">+{points} points</span>
 </div>
 
@@ -1929,17 +2320,7 @@ Your approach correctly applies the principles of **{concept}** as outlined in t
 <strong>From the source material:</strong> This demonstrates proper application of {concept} principles.
 </div>"""
 
-        story.add_passage(Passage(
-            name=f"Correct {scenario_num}",
-            content=correct_content,
-            choices=[Choice("Continue", next_scenario)],
-            tags=["correct", f"concept-{scenario_num}"],
-            position_y=y_pos
-        ))
-        y_pos += 150
-
-        for suffix in ['a', 'b']:
-            incorrect_content = f"""<div class="feedback-incorrect">
+_TEMPLATE_INCORRECT_TMPL = """<div class="feedback-incorrect">
 <strong>This approach has issues.</strong> <span class="points-missed">0 points</span>
 </div>
 
@@ -1949,33 +2330,119 @@ This choice doesn't align with the proper application of **{concept}** principle
 <strong>Review:</strong> The source material explains the correct approach to {concept}.
 </div>"""
 
-            story.add_passage(Passage(
+_TEMPLATE_RESULTS_TMPL = """<div class="chapter-header">
+<span class="chapter-num">Complete</span>
+<h2>{theme}</h2>
+</div>
+
+{{RESULTS_BOX}}
+
+Thank you for completing this assessment. Your score reflects your ability to apply the course concepts."""
+
+
+def generate_template_scenario(content: EducationalContent,
+                                decision_nodes: int = 4, branches_per_node: int = 3) -> TwineStory:
+    """
+    Generate a template-based educational scenario (fallback when AI unavailable).
+    """
+    grading_config = GradingConfig(
+        enabled=True,
+        concept_points={c.name: c.points for c in content.key_concepts},
+        passing_threshold=content.passing_threshold,
+        total_points=content.total_points,
+        passing_points=content.passing_points
+    )
+
+    story = TwineStory(title=f"EdQuest: {content.theme}", grading=grading_config)
+    theme_context = get_theme_context(content.theme)
+    atmosphere = theme_context['atmosphere']
+    npcs = theme_context['npcs']
+    n_npcs = len(npcs)
+
+    # Build introduction
+    objectives_text = "\n".join(["- %s" % obj for obj in content.learning_objectives])
+    concepts_text = "\n".join(["- %s (%s pts)" % (c.name, c.points) for c in content.key_concepts])
+
+    intro_content = _TEMPLATE_INTRO_TMPL.format_map({
+        'theme': content.theme,
+        'atmosphere': atmosphere,
+        'setting': theme_context['setting'],
+        'role': theme_context['role'],
+        'objectives_text': objectives_text,
+        'concepts_text': concepts_text,
+        'total_points': content.total_points,
+        'passing_threshold': content.passing_threshold
+    })
+
+    story.add_passage(Passage(
+        name="Start",
+        content=intro_content,
+        choices=[Choice("Begin the scenario", "Scenario 1")]
+    ))
+
+    # Generate scenario for each concept
+    num_concepts = len(content.key_concepts)
+    next_names = [f"Scenario {k}" for k in range(2, num_concepts + 1)] + ["Results"]
+
+    new_passages = []
+    for i, concept_obj in enumerate(content.key_concepts):
+        concept = concept_obj.name
+        points = concept_obj.points
+        scenario_num = i + 1
+        next_scenario = next_names[i]
+        concept_tag = sys.intern(f"concept-{scenario_num}")
+
+        npc = npcs[i % n_npcs]
+
+        scenario_content = _TEMPLATE_SCENARIO_TMPL.format_map({
+            'scenario_num': scenario_num,
+            'concept': concept,
+            'atmosphere': atmosphere,
+            'npc': npc
+        })
+
+        new_passages.append(Passage(
+            name=f"Scenario {scenario_num}",
+            content=scenario_content,
+            choices=[
+                Choice(f"Apply established {concept} principles", f"Correct {scenario_num}"),
+                Choice("Take a simplified approach", f"Incorrect {scenario_num}a"),
+                Choice("Defer the decision", f"Incorrect {scenario_num}b"),
+            ]
+        ))
+
+        correct_content = _TEMPLATE_CORRECT_TMPL.format_map({'points': points, 'concept': concept})
+
+        new_passages.append(Passage(
+            name=f"Correct {scenario_num}",
+            content=correct_content,
+            choices=[Choice("Continue", next_scenario)],
+            tags=["correct", concept_tag]
+        ))
+
+        # Both incorrect passages share the same body
+        incorrect_content = _TEMPLATE_INCORRECT_TMPL.format_map({'concept': concept})
+
+        for suffix in ['a', 'b']:
+            new_passages.append(Passage(
                 name=f"Incorrect {scenario_num}{suffix}",
                 content=incorrect_content,
                 choices=[
                     Choice("Try again", f"Scenario {scenario_num}"),
                     Choice("Continue", next_scenario)
                 ],
-                tags=["incorrect", f"concept-{scenario_num}"],
-                position_y=y_pos
+                tags=["incorrect", concept_tag]
             ))
-            y_pos += 150
 
-    results_content = f"""<div class="chapter-header">
-<span class="chapter-num">Complete</span>
-<h2>{content.theme}</h2>
-</div>
-
-{{RESULTS_BOX}}
+    story.extend_passages(new_passages)
 
-Thank you for completing this assessment. Your score reflects your ability to apply the course concepts."""
+    results_content = _TEMPLATE_RESULTS_TMPL.format_map({'theme': content.theme})
 
     story.add_passage(Passage(
         name="Results",
         content=results_content,
         choices=[Choice("Start Again", "Start")],
-        tags=["ending", "results"],
-        position_y=y_pos
+        tags=["ending", "results"]
     ))
 
     return story
@@ -1991,11 +2458,26 @@ def main():
     parser.add_argument("-o", "--output", help="Output HTML filename")
     parser.add_argument("--demo", action="store_true", help="Generate demo scenario")
     parser.add_argument("--api-key", help="Anthropic API key (or set ANTHROPIC_API_KEY env var)")
+    parser.add_argument("--batch", nargs="+", metavar="INPUT_FILE",
+                        help="Generate scenarios for several JSON files via the Message Batches API "
+                             "(half the cost, but not interactive)")
 
     args = parser.parse_args()
 
     api_key = args.api_key or os.environ.get('ANTHROPIC_API_KEY')
 
+    if args.batch:
+        if not api_key:
+            parser.error("--batch requires an API key (--api-key or ANTHROPIC_API_KEY)")
+        contents = [EducationalContent.from_json_file(f) for f in args.batch]
+        stories = generate_educational_scenarios_batch(contents, api_key)
+        for input_file, story in zip(args.batch, stories):
+            output_file = Path(input_file).stem + "_scenario.html"
+            with open(output_file, 'w', encoding='utf-8', buffering=1 << 16) as f:
+                story.stream_html(f)
+            print(f"Generated: {output_file}")
+        return 0
+
     if args.demo or not args.input_file:
         print("Demo mode - creating sample scenario...")
         content = EducationalContent(
@@ -2019,10 +2501,9 @@ def main():
         output_file = args.output or Path(args.input_file).stem + "_scenario.html"
 
     story = generate_educational_scenario(content, api_key)
-    html_content = story.generate_html()
 
-    with open(output_file, 'w', encoding='utf-8') as f:
-        f.write(html_content)
+    with open(output_file, 'w', encoding='utf-8', buffering=1 << 16) as f:
+        story.stream_html(f)
 
     print(f"Generated: {output_file}")
     return 0